@@ -0,0 +1,41 @@
+from bson.binary import Binary
+import json
+import os
+import zlib
+
+# Bodies are stored apart from `posts` and `replies`, zlib compressed in
+# `content` under the comment's _id, like the indexer does (see content.py
+# there). With content_metadata_threshold set, so is any json_metadata larger
+# than that many bytes, the comment keeping only the metadata_fields.
+#
+# Each service is built from its own directory, this is the indexer's split
+# without its readers, and has to be kept in step with it.
+
+metadata_threshold = int(os.environ['content_metadata_threshold']) if 'content_metadata_threshold' in os.environ else 0
+metadata_fields = ['app', 'format', 'tags']
+
+
+def compress(value):
+    return Binary(zlib.compress(value.encode('utf-8')))
+
+
+def split_content(comment):
+    # The fields to store in `posts` or `replies`, and the `content` document
+    stored = dict(comment)
+    content = {'_id': comment['_id'], 'body': compress(stored.pop('body', ''))}
+    metadata = stored.get('json_metadata')
+    if metadata_threshold and isinstance(metadata, dict):
+        encoded = json.dumps(metadata)
+        if len(encoded) > metadata_threshold:
+            content['json_metadata'] = compress(encoded)
+            stored['json_metadata'] = {k: v for k, v in metadata.items() if k in metadata_fields}
+    return stored, content
+
+
+def stored_update(stored):
+    # The update saving a split comment, dropping any body from before the split
+    return {'$set': stored, '$unset': {'body': True}}
+
+
+def save_content(db, content):
+    db.content.replace_one({'_id': content['_id']}, content, upsert=True)
@@ -15,6 +15,7 @@ from steem.converter import Converter
 from steem.steemd import Steemd
 from steem.utils import block_num_from_hash
 from bs4 import BeautifulSoup
+from content import save_content, split_content, stored_update
 
 #########################################
 # Connections
@@ -136,14 +137,20 @@ def load_post(_id, author, permlink):
         except ValueError:
             comment[key] = comment[key]
 
-    # Update the post in the DB since we have it
+    # Update the post in the DB since we have it, with the body in `content`
+    stored, content = split_content(comment)
+    # Archived threads (see archive.py in the indexer) are updated in place
+    posts, replies = db.posts, db.replies
+    if db.posts_archive.find_one({'_id': _id}, {'_id': 1}) or db.replies_archive.find_one({'_id': _id}, {'_id': 1}):
+        posts, replies = db.posts_archive, db.replies_archive
     # If this is a top level post, update the `posts` collection
     if comment['parent_author'] == '':
-        db.posts.update({'_id': _id}, {'$set': comment}, upsert=True)
+        posts.update({'_id': _id}, stored_update(stored), upsert=True)
     # Otherwise save it into the `replies` collection and update the parent
     else:
         # Update this post within the `replies` collection
-        db.replies.update({'_id': _id}, {'$set': comment}, upsert=True)
+        replies.update({'_id': _id}, stored_update(stored), upsert=True)
+    save_content(db, content)
 
     return comment
 
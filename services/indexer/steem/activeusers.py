@@ -0,0 +1,87 @@
+from bson.binary import Binary
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import threading
+
+from hll import HyperLogLog
+
+# Unique active users per app, counted in memory as comments are indexed and
+# flushed into HyperLogLog buckets in `activeusers_hll`: one per app (and `*`
+# for all apps) for each minute, hour and day, of the block the comment is in
+# so blocks replayed while catching up land where they belong. The statistics
+# service merges the buckets into the users-1h, users-24h and users-7d
+# documents.
+#
+# The most recent users of one app (the forum's own) are also kept, for the
+# homepage, in `activeusers_recent`.
+
+# Granularity, how to truncate a time to its bucket and how long it's kept
+granularities = [
+    ('minute', lambda ts: ts.replace(second=0, microsecond=0), timedelta(hours=2)),
+    ('hour', lambda ts: ts.replace(minute=0, second=0, microsecond=0), timedelta(days=2)),
+    ('day', lambda ts: ts.replace(hour=0, minute=0, second=0, microsecond=0), timedelta(days=8)),
+]
+
+all_apps = '*'
+
+
+class ActiveUsers(object):
+    def __init__(self, db, recent_app, recent_size=100):
+        self.db = db
+        self.recent_app = recent_app
+        self.recent_size = recent_size
+        self.lock = threading.Lock()
+        self.sketches = {}
+        self.recent = OrderedDict()
+
+    def add(self, app, user, ts):
+        now = datetime.utcnow()
+        with self.lock:
+            for granularity, truncate, keep in granularities:
+                start = truncate(ts)
+                # Too old to be kept anyway
+                if start + keep <= now:
+                    continue
+                for key in [app, all_apps]:
+                    key = (granularity, start, key)
+                    if key not in self.sketches:
+                        self.sketches[key] = HyperLogLog()
+                    self.sketches[key].add(user)
+            if app == self.recent_app:
+                self.recent.pop(user, None)
+                self.recent[user] = ts
+                while len(self.recent) > self.recent_size:
+                    self.recent.popitem(last=False)
+
+    def flush(self, now=None):
+        # Merge what was seen since the last flush into its buckets.
+        # The indexer is the only writer, so read-merge-write is safe.
+        now = now or datetime.utcnow()
+        with self.lock:
+            sketches, self.sketches = self.sketches, {}
+            recent, self.recent = self.recent, OrderedDict()
+        keeps = {granularity: keep for granularity, truncate, keep in granularities}
+        for (granularity, start, app), sketch in sketches.items():
+            expires = start + keeps[granularity]
+            if expires <= now:
+                continue
+            _id = '{}:{}:{}'.format(granularity, start.strftime('%Y%m%d%H%M'), app)
+            stored = self.db.activeusers_hll.find_one({'_id': _id}, {'registers': 1})
+            if stored:
+                sketch = HyperLogLog(sketch.registers)
+                sketch.merge(HyperLogLog(stored['registers']))
+            self.db.activeusers_hll.update({'_id': _id}, {'$set': {
+                'granularity': granularity,
+                'start': start,
+                'app': app,
+                'registers': Binary(bytes(sketch.registers)),
+                'expires': expires,
+            }}, upsert=True)
+        if recent:
+            stored = self.db.activeusers_recent.find_one({'_id': self.recent_app}) or {'users': []}
+            users = {user['_id']: user['ts'] for user in stored['users']}
+            users.update(recent)
+            latest = sorted(users.items(), key=lambda user: user[1], reverse=True)[:self.recent_size]
+            self.db.activeusers_recent.update({'_id': self.recent_app}, {'$set': {
+                'users': [{'_id': user, 'ts': ts} for user, ts in latest],
+            }}, upsert=True)
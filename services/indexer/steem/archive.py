@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+from pymongo import ReplaceOne
+import threading
+
+# Threads that were paid out and have been inactive for a while are moved,
+# the post with all of its replies, from `posts` and `replies` into
+# `posts_archive` and `replies_archive`. Those only carry the indexes of the
+# lookups still made on them, so the active collections' indexes stay small.
+# Bodies stay in `content` either way.
+#
+# A thread that sees a new reply, an edit, a deletion or moderation is moved
+# back before it's written to. Votes on archived content aren't refetched.
+# The REST loaders fall back to the archive for posts, threads and account
+# histories.
+#
+# Moving and restoring hold `lock`, which the indexer also holds while it
+# processes an op, so a thread is never written to halfway through a move.
+
+
+class Archive(object):
+    def __init__(self, db, days=30, batch_size=100):
+        self.db = db
+        # How long a paid out thread has to be inactive, None to never archive
+        self.age = timedelta(days=days) if days else None
+        self.batch_size = batch_size
+        self.lock = threading.RLock()
+
+    def run(self, now=None):
+        if not self.age:
+            return 0
+        now = now or datetime.utcnow()
+        moved = 0
+        while True:
+            with self.lock:
+                posts = list(self.db.posts.find({
+                    'active': {'$lt': now - self.age},
+                    'cashout_time': {'$lt': now},
+                }).limit(self.batch_size))
+                if posts:
+                    self.move(posts, self.db.posts, self.db.replies, self.db.posts_archive, self.db.replies_archive)
+            moved += len(posts)
+            if len(posts) < self.batch_size:
+                return moved
+
+    def move(self, posts, from_posts, from_replies, to_posts, to_replies):
+        # Copied first, a crash in between leaves the threads in both places
+        # and the next run (or restore) finishes moving them
+        ids = [post['_id'] for post in posts]
+        replies = list(from_replies.find({'root_post': {'$in': ids}}))
+        to_posts.bulk_write([ReplaceOne({'_id': post['_id']}, post, upsert=True) for post in posts], ordered=False)
+        if replies:
+            to_replies.bulk_write([ReplaceOne({'_id': reply['_id']}, reply, upsert=True) for reply in replies], ordered=False)
+            from_replies.delete_many({'_id': {'$in': [reply['_id'] for reply in replies]}})
+        from_posts.delete_many({'_id': {'$in': ids}})
+
+    def restore(self, post_id):
+        # Move an archived thread back, returns whether it was archived
+        with self.lock:
+            post = self.db.posts_archive.find_one({'_id': post_id})
+            if post:
+                self.move([post], self.db.posts_archive, self.db.replies_archive, self.db.posts, self.db.replies)
+            return bool(post)
+
+    def restore_comment(self, _id):
+        # Move back the thread a post or reply belongs to
+        with self.lock:
+            if self.restore(_id):
+                return True
+            reply = self.db.replies_archive.find_one({'_id': _id}, {'root_post': 1})
+            return bool(reply) and self.restore(reply['root_post'])
+
+    def archived(self, ids):
+        # Which of the posts and replies are archived
+        found = set()
+        for collection in [self.db.posts_archive, self.db.replies_archive]:
+            found.update(doc['_id'] for doc in collection.find({'_id': {'$in': ids}}, {'_id': 1}))
+        return found
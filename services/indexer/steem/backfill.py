@@ -0,0 +1,195 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+import sys
+import threading
+
+from content import collapse_votes, normalize, save_content, split_content, stored_update
+from feed import queue_rebuild
+
+# Fills in the history of the tags and accounts a forum starts listing. The
+# indexer only sees what's posted from the block it started at, a forum that
+# adds a tag would otherwise miss every older post under it.
+#
+# Each tag or account is a job in `backfill_jobs`. Its posts are listed from
+# the node newest first, a page at a time, and the ones missing from `posts`
+# are fetched with their replies by a pool of workers and upserted together.
+# The position is saved after every page, so an interrupted job resumes where
+# it stopped. Once done, the forums it was queued for are queued for a rebuild.
+#
+# Pages are saved holding the indexer's op lock, so the block loop never
+# writes to the same threads in between.
+
+page_size = 100
+
+
+def log(msg):
+    print('[FORUM][BACKFILL] {}'.format(msg))
+    sys.stdout.flush()
+
+
+def queue_backfill(db, forum, tags=[], accounts=[]):
+    # Jobs already queued for another forum are shared, finished ones start over
+    now = datetime.utcnow()
+    ops = []
+    for kind, values in [('tag', tags), ('account', accounts)]:
+        for value in values:
+            ops.append(UpdateOne({'_id': '{}:{}'.format(kind, value)}, {
+                '$addToSet': {'forums': forum},
+                '$set': {'done': False},
+                '$inc': {'version': 1},
+                '$setOnInsert': {'kind': kind, 'value': value, 'queued': now, 'fetched': 0},
+            }, upsert=True))
+    if ops:
+        db.backfill_jobs.bulk_write(ops, ordered=False)
+    return len(ops)
+
+
+def added(before, after, field):
+    # The values of `field` the forum didn't list before
+    previous = set(before.get(field) or [])
+    return [value for value in after.get(field) or [] if value not in previous]
+
+
+class Backfill(object):
+    def __init__(self, db, steem, workers=8, days=90, search_index=None, log=log, lock=None):
+        self.db = db
+        self.lock = lock or threading.RLock()
+        self.steem = steem
+        self.workers = workers
+        # How far back to go, None for everything the node has
+        self.age = timedelta(days=days) if days else None
+        self.search_index = search_index
+        self.log = log
+
+    def run(self):
+        # Work through the pending jobs, oldest first
+        done = 0
+        for job in list(self.db.backfill_jobs.find({'done': False}).sort('queued', 1)):
+            try:
+                self.process(job)
+                done += 1
+            except Exception as e:
+                # Resumes from its last page on the next run
+                self.log('{} - failed: {}'.format(job['_id'], e))
+        return done
+
+    def page(self, job, cursor):
+        # A page of the job's posts from the node, starting with the cursor
+        if job['kind'] == 'tag':
+            query = {'tag': job['value'], 'limit': page_size}
+            if cursor:
+                query.update({'start_author': cursor['author'], 'start_permlink': cursor['permlink']})
+            return self.steem.get_discussions_by_created(query)
+        permlink = cursor['permlink'] if cursor else ''
+        return self.steem.get_discussions_by_author_before_date(job['value'], permlink, '2100-01-01T00:00:00', page_size)
+
+    def process(self, job):
+        since = datetime.utcnow() - self.age if self.age else None
+        cursor = job.get('cursor')
+        fetched = job.get('fetched', 0)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                page = self.page(job, cursor)
+                complete = len(page) < page_size
+                if cursor and page and page[0]['author'] == cursor['author'] and page[0]['permlink'] == cursor['permlink']:
+                    page = page[1:]
+                if not page:
+                    break
+                listed = []
+                for entry in page:
+                    created = datetime.strptime(entry['created'], '%Y-%m-%dT%H:%M:%S')
+                    if since and created < since:
+                        complete = True
+                        break
+                    # Tag listings include posts that only mention the tag
+                    if entry['parent_author'] == '' and (job['kind'] != 'tag' or entry['category'] == job['value']):
+                        listed.append(entry['author'] + '/' + entry['permlink'])
+                stored = set()
+                for collection in [self.db.posts, self.db.posts_archive]:
+                    stored.update(post['_id'] for post in collection.find({'_id': {'$in': listed}}, {'_id': 1}))
+                missing = [_id for _id in listed if _id not in stored]
+                threads = [thread for thread in pool.map(self.fetch_thread, missing) if thread]
+                self.save(threads)
+                fetched += len(threads)
+                cursor = {'author': page[-1]['author'], 'permlink': page[-1]['permlink']}
+                self.db.backfill_jobs.update({'_id': job['_id']}, {'$set': {
+                    'cursor': cursor,
+                    'fetched': fetched,
+                    'updated': datetime.utcnow(),
+                }})
+                self.log('{} - {} posts fetched'.format(job['_id'], fetched))
+                if complete:
+                    break
+        # Unless it was queued again meanwhile, then the next run finishes it
+        result = self.db.backfill_jobs.update({'_id': job['_id'], 'version': job['version']}, {
+            '$set': {'done': True, 'finished': datetime.utcnow()},
+            '$unset': {'cursor': True},
+        })
+        if result['n']:
+            self.rebuild(job['forums'])
+
+    def fetch_thread(self, _id):
+        # The post and all of its replies, in our storage format
+        author, permlink = _id.split('/', 1)
+        post = normalize(self.steem.get_content(author, permlink), _id)
+        if post['author'] == '':
+            return None
+        post['active_votes'] = collapse_votes(post['active_votes'])
+        replies = []
+        if post['children'] > 0:
+            self.fetch_replies(post, post, replies)
+        if replies:
+            latest = max(replies, key=lambda reply: reply['created'])
+            post.update({
+                'last_reply': latest['created'],
+                'last_reply_by': latest['author'],
+                'last_reply_url': latest['url'],
+            })
+        return post, replies
+
+    def fetch_replies(self, post, parent, replies):
+        for reply in self.steem.get_content_replies(parent['author'], parent['permlink']):
+            reply = normalize(reply, reply['author'] + '/' + reply['permlink'])
+            reply.update({
+                'active_votes': collapse_votes(reply.get('active_votes', [])),
+                'parent_id': reply['parent_author'] + '/' + reply['parent_permlink'],
+                'root_post': post['_id'],
+                'root_namespace': post['namespace'] if 'namespace' in post else False,
+            })
+            replies.append(reply)
+            if reply['children'] > 0:
+                self.fetch_replies(post, reply, replies)
+
+    def save(self, threads):
+        with self.lock:
+            # What the indexer stored since the page was fetched is newer
+            stored = set()
+            for collection in [self.db.posts, self.db.posts_archive]:
+                stored.update(post['_id'] for post in collection.find({'_id': {'$in': [post['_id'] for post, thread in threads]}}, {'_id': 1}))
+            threads = [(post, thread) for post, thread in threads if post['_id'] not in stored]
+            reply_ids = [reply['_id'] for post, thread in threads for reply in thread]
+            stored.update(reply['_id'] for reply in self.db.replies.find({'_id': {'$in': reply_ids}}, {'_id': 1}))
+            posts = []
+            replies = []
+            contents = []
+            for post, thread in threads:
+                for comment, ops in [(post, posts)] + [(reply, replies) for reply in thread if reply['_id'] not in stored]:
+                    split, content = split_content(comment)
+                    ops.append(UpdateOne({'_id': split['_id']}, stored_update(split), upsert=True))
+                    contents.append(content)
+            if posts:
+                self.db.posts.bulk_write(posts, ordered=False)
+            if replies:
+                self.db.replies.bulk_write(replies, ordered=False)
+            save_content(self.db, contents)
+            if self.search_index and posts:
+                for post, replies in threads:
+                    self.search_index.index(post, commit=False)
+                self.search_index.commit()
+
+    def rebuild(self, forums):
+        # The forums' feed, counters and recent content include the history
+        # now, rebuilt by the indexer (see queue_rebuild)
+        for forum in forums:
+            queue_rebuild(self.db, forum)
@@ -0,0 +1,103 @@
+from bson.binary import Binary
+from datetime import datetime
+from pymongo import ReplaceOne
+import json
+import os
+import zlib
+
+# Remaps comments as the rpc returns them (get_content, get_content_replies)
+# into the format stored in `posts` and `replies`.
+#
+# Bodies are stored apart, zlib compressed in `content` under the comment's
+# _id, so the posts and replies the list routes scan stay small. With
+# content_metadata_threshold set, so is any json_metadata larger than that
+# many bytes, the comment keeping only the metadata_fields the lists show. The REST service joins
+# them back when loading a post or thread.
+
+dropped_fields = ['abs_rshares', 'children_rshares2', 'net_rshares', 'children_abs_rshares', 'vote_rshares', 'total_vote_weight', 'root_comment', 'promoted', 'max_cashout_time', 'body_length', 'reblogged_by', 'replies']
+float_fields = ['author_reputation']
+amount_fields = ['total_pending_payout_value', 'pending_payout_value', 'max_accepted_payout', 'total_payout_value', 'curator_payout_value']
+date_fields = ['active', 'created', 'cashout_time', 'last_payout', 'last_update']
+
+metadata_threshold = int(os.environ['content_metadata_threshold']) if 'content_metadata_threshold' in os.environ else 0
+metadata_fields = ['app', 'format', 'tags']
+
+
+def normalize(comment, _id):
+    comment = comment.copy()
+    # Add our ID
+    comment.update({
+        '_id': _id,
+    })
+    # Remap into our storage format
+    for key in dropped_fields:
+        comment.pop(key, None)
+    for key in float_fields:
+        comment[key] = float(comment[key])
+    for key in amount_fields:
+        comment[key] = float(comment[key].split()[0])
+    for key in date_fields:
+        comment[key] = datetime.strptime(comment[key], '%Y-%m-%dT%H:%M:%S')
+    for key in ['json_metadata']:
+        try:
+            comment[key] = json.loads(comment[key])
+        except ValueError:
+            comment[key] = comment[key]
+    return comment
+
+
+def collapse_votes(votes):
+    collapsed = []
+    # Convert time to timestamps
+    for key, vote in enumerate(votes):
+        votes[key]['time'] = int(datetime.strptime(
+            votes[key]['time'], '%Y-%m-%dT%H:%M:%S').strftime('%s'))
+    # Sort based on time
+    sortedVotes = sorted(votes, key=lambda k: k['time'])
+    # Iterate and append to return value
+    for vote in votes:
+        collapsed.append([
+            vote['voter'],
+            vote['percent']
+        ])
+    return collapsed
+
+
+def compress(value):
+    return Binary(zlib.compress(value.encode('utf-8')))
+
+
+def split_content(comment):
+    # The fields to store in `posts` or `replies`, and the `content` document
+    stored = dict(comment)
+    content = {'_id': comment['_id'], 'body': compress(stored.pop('body', ''))}
+    metadata = stored.get('json_metadata')
+    if metadata_threshold and isinstance(metadata, dict):
+        encoded = json.dumps(metadata)
+        if len(encoded) > metadata_threshold:
+            content['json_metadata'] = compress(encoded)
+            stored['json_metadata'] = {k: v for k, v in metadata.items() if k in metadata_fields}
+    return stored, content
+
+
+def stored_update(stored):
+    # The update saving a split comment, dropping any body from before the split
+    return {'$set': stored, '$unset': {'body': True}}
+
+
+def content_op(content):
+    return ReplaceOne({'_id': content['_id']}, content, upsert=True)
+
+
+def save_content(db, contents):
+    if contents:
+        db.content.bulk_write([content_op(content) for content in contents], ordered=False)
+
+
+def decompress(value):
+    return zlib.decompress(value).decode('utf-8')
+
+
+def load_bodies(db, ids):
+    # The bodies of comments by _id
+    return {content['_id']: decompress(content['body']) for content in db.content.find({'_id': {'$in': ids}}, {'body': 1})}
@@ -0,0 +1,108 @@
+from datetime import datetime
+import re
+
+from pymongo import UpdateOne
+
+from feed import forum_matches, forum_query
+
+# The `stats.posts` and `stats.replies` counters of each forum. The indexer
+# applies a delta whenever a post or reply enters or leaves a forum (created,
+# deleted, removed or restored by a moderator), and reconcile() recounts
+# them now and then to correct any drift. Other processes queue_recount()
+# instead, see process_forum_recounts there.
+#
+# A post counts for the forums that list it (see feed.py), a reply for the
+# forums that list its thread, and neither for a forum that removed them.
+
+
+def reply_as_post(reply):
+    # The fields a forum matches a thread on, as seen from one of its replies
+    return {
+        'author': reply['root_post'].split('/')[0] if reply.get('root_post') else reply.get('author'),
+        'category': reply.get('category'),
+        'namespace': reply.get('root_namespace'),
+    }
+
+
+def counted_in(forums, comment):
+    # The forums that count a stored post or reply
+    removed = comment.get('_removedFrom', [])
+    post = reply_as_post(comment) if comment.get('parent_author') else comment
+    return [_id for _id, forum in forums.items() if forum_matches(_id, forum, post) and _id not in removed]
+
+
+def apply(db, forums, field, delta):
+    # Returns whether any forum's counter changed
+    if forums and delta:
+        db.forums.bulk_write([
+            UpdateOne({'_id': forum}, {'$inc': {'stats.' + field: delta}}) for forum in forums
+        ], ordered=False)
+        return True
+    return False
+
+
+def count_created(db, forums, comment):
+    field = 'replies' if comment.get('parent_author') else 'posts'
+    return apply(db, counted_in(forums, comment), field, 1)
+
+
+def count_deleted(db, forums, comment):
+    field = 'replies' if comment.get('parent_author') else 'posts'
+    return apply(db, counted_in(forums, comment), field, -1)
+
+
+def count_moderated(db, forums, forum, post, replies, removed):
+    # A moderator removed (or restored) the post and `replies` of its replies
+    # that weren't already, the counts only change if the forum lists the thread
+    if forum in forums and forum_matches(forum, forums[forum], post):
+        delta = -1 if removed else 1
+        apply(db, [forum], 'posts', delta)
+        apply(db, [forum], 'replies', delta * replies)
+
+
+def reply_query(_id, forum):
+    # The replies counted for a forum, as a query on `replies`
+    if not forum.get('tags') and not forum.get('accounts'):
+        return None
+    query = {'_removedFrom': {'$ne': _id}}
+    if forum.get('tags'):
+        query['category'] = {'$in': forum['tags']}
+    if forum.get('accounts'):
+        # Anchored prefixes are bounds on the root_post index
+        query['$or'] = [{'root_post': {'$regex': '^' + re.escape(account) + '/'}} for account in forum['accounts']]
+    if forum.get('exclusive') == True:
+        query['root_namespace'] = _id
+    return query
+
+
+def count_forum(db, _id, forum):
+    posts = forum_query(_id, forum)
+    replies = reply_query(_id, forum)
+    # Archived threads (see archive.py) still count
+    return {
+        'posts': db.posts.count(posts) + db.posts_archive.count(posts) if posts else 0,
+        'replies': db.replies.count(replies) + db.replies_archive.count(replies) if replies else 0,
+    }
+
+
+def reconcile(db, _id, forum):
+    # Recount one forum, returning the counts if they had drifted. Only safe
+    # while nothing else counts: the indexer calls this holding its op lock,
+    # snapshot.py before the indexer runs on the imported database. A post
+    # counted between reading the counters and recounting is counted twice.
+    current = (db.forums.find_one({'_id': _id}, {'stats': 1}) or {}).get('stats', {})
+    stats = count_forum(db, _id, forum)
+    delta = {'stats.' + k: stats[k] - current.get(k, 0) for k in ['posts', 'replies'] if stats[k] != current.get(k)}
+    if not delta:
+        return False
+    db.forums.update({'_id': _id}, {'$inc': delta})
+    return stats
+
+
+def queue_recount(db, forum):
+    # Recounted by the indexer under its op lock, where nothing is counted
+    # meanwhile (see process_forum_recounts)
+    db.forum_recounts.update({'_id': forum}, {
+        '$inc': {'version': 1},
+        '$setOnInsert': {'queued': datetime.utcnow()},
+    }, upsert=True)
@@ -0,0 +1,119 @@
+from datetime import datetime
+
+from feed import matching_forums
+
+# The `events` collection is a capped log of what the indexer changed, which
+# the REST service tails and pushes to subscribed clients (/events). Every
+# event lists the channels it's delivered on:
+#
+#   forum:<slug>       new posts, replies, moderation and funding of the forum
+#   thread:<post id>   replies, edits, votes and moderation within a thread
+#   user:<username>    replies to the user's posts and replies
+#
+# The statistics service also rolls the forum events up into time series.
+#
+# Being capped, old events fall off on their own, and clients that were away
+# for longer than the log covers reload the page instead of replaying it.
+
+events_size = 64 * 1024 * 1024
+
+post_fields = [
+    '_id',
+    'author',
+    'category',
+    'children',
+    'created',
+    'last_reply',
+    'last_reply_by',
+    'last_reply_url',
+    'namespace',
+    'permlink',
+    'title',
+    'url',
+]
+
+reply_fields = [
+    '_id',
+    'author',
+    'body',
+    'category',
+    'created',
+    'depth',
+    'parent_author',
+    'parent_id',
+    'parent_permlink',
+    'permlink',
+    'root_post',
+    'url',
+]
+
+
+def ensure_events(db, size=events_size):
+    if 'events' not in db.collection_names():
+        db.create_collection('events', capped=True, size=size)
+
+
+def forum_channels(forums, post):
+    removed = post.get('_removedFrom', [])
+    return ['forum:' + forum for forum in matching_forums(forums, post) if forum not in removed]
+
+
+def emit(db, kind, channels, data, ts=None):
+    if channels:
+        db.events.insert({
+            'type': kind,
+            'ts': ts or datetime.utcnow(),
+            'channels': channels,
+            'data': data,
+        })
+
+
+def emit_post(db, forums, post, edit=False, ts=None):
+    data = {k: post[k] for k in post_fields if k in post}
+    channels = forum_channels(forums, post) + ['thread:' + post['_id']]
+    emit(db, 'edit' if edit else 'post', channels, data, ts)
+
+
+def emit_reply(db, forums, reply, root_post, edit=False, ts=None):
+    data = {k: reply[k] for k in reply_fields if k in reply}
+    channels = ['thread:' + reply['root_post']]
+    if not edit:
+        # Only new replies bump the forum and notify the parent's author
+        if root_post:
+            channels += forum_channels(forums, root_post)
+        if reply['parent_author'] != reply['author']:
+            channels.append('user:' + reply['parent_author'])
+    emit(db, 'edit' if edit else 'reply', channels, data, ts)
+
+
+def emit_vote(db, comment, root_post):
+    emit(db, 'vote', ['thread:' + root_post], {
+        '_id': comment['_id'],
+        'net_votes': comment.get('net_votes', 0),
+        'pending_payout_value': comment.get('pending_payout_value', 0),
+        'votes': len(comment.get('active_votes', [])),
+    })
+
+
+def emit_moderation(db, forum, topic, removed, ts=None):
+    emit(db, 'moderation', ['forum:' + forum, 'thread:' + topic], {
+        '_id': topic,
+        'forum': forum,
+        'removed': removed,
+    }, ts)
+
+
+def emit_delete(db, forums, comment, ts=None):
+    root = comment.get('root_post', comment['_id'])
+    channels = ['thread:' + root]
+    if 'root_post' not in comment:
+        channels += forum_channels(forums, comment)
+    emit(db, 'delete', channels, {'_id': comment['_id'], 'root_post': root}, ts)
+
+
+def emit_funding(db, forum, sender, steem_value, ts):
+    # Timed by the transfer, which may be old while the indexer catches up
+    emit(db, 'funding', ['forum:' + forum], {
+        'from': sender,
+        'steem_value': steem_value,
+    }, ts)
@@ -0,0 +1,127 @@
+from datetime import datetime
+from pymongo import DeleteMany, UpdateOne
+import threading
+
+# The `forum_feed` collection holds one entry per (forum, post) with the
+# fields /forum/<slug> lists, so a forum page is a range scan over the
+# {forum: 1, active: -1} index instead of an in-memory sort across its tags.
+# Posts removed from a forum by its moderators have no entry in that forum.
+
+feed_fields = [
+    'active',
+    'author',
+    'category',
+    'cbb',
+    'created',
+    'children',
+    'funded',
+    'json_metadata',
+    'last_reply',
+    'last_reply_by',
+    'last_reply_url',
+    'max_accepted_payout',
+    'namespace',
+    'percent_steem_dollars',
+    'permlink',
+    'title',
+    'url',
+]
+
+
+def forum_matches(_id, forum, post):
+    # Mirrors the query /forum/<slug> builds for the forum
+    tags = forum.get('tags') or []
+    accounts = forum.get('accounts') or []
+    if not tags and not accounts:
+        return False
+    if tags and post.get('category') not in tags:
+        return False
+    if accounts and post.get('author') not in accounts:
+        return False
+    if forum.get('exclusive') == True and post.get('namespace') != _id:
+        return False
+    return True
+
+
+def matching_forums(forums, post):
+    return [_id for _id, forum in forums.items() if forum_matches(_id, forum, post)]
+
+
+def feed_entry(forum, post):
+    entry = {k: post[k] for k in feed_fields if k in post}
+    entry.update({
+        'forum': forum,
+        'post': post['_id'],
+    })
+    return entry
+
+
+def update_feed(db, forums, post):
+    # Sync the entries of a stored post (as it is in `posts`, with its
+    # _removedFrom) with the forums it currently belongs to
+    removed = post.get('_removedFrom', [])
+    listed = [forum for forum in matching_forums(forums, post) if forum not in removed]
+    ops = [UpdateOne({'_id': forum + '|' + post['_id']}, {'$set': feed_entry(forum, post)}, upsert=True) for forum in listed]
+    ops.append(DeleteMany({'post': post['_id'], 'forum': {'$nin': listed}}))
+    db.forum_feed.bulk_write(ops, ordered=False)
+
+
+def remove_from_feed(db, post_id, forum=False):
+    query = {'post': post_id}
+    if forum:
+        query['forum'] = forum
+    db.forum_feed.delete_many(query)
+
+
+def forum_query(_id, forum):
+    # The posts listed in a forum, as a query on `posts`
+    if not forum.get('tags') and not forum.get('accounts'):
+        return None
+    query = {'_removedFrom': {'$ne': _id}}
+    if forum.get('tags'):
+        query['category'] = {'$in': forum['tags']}
+    if forum.get('accounts'):
+        query['author'] = {'$in': forum['accounts']}
+    if forum.get('exclusive') == True:
+        query['namespace'] = _id
+    return query
+
+
+def rebuild_forum_feed(db, _id, forum, batch_size=1000, lock=None):
+    # Recreate every entry of one forum, ie: after its tags or accounts changed.
+    # Given the indexer's op lock, each batch is read and written under it, so
+    # ops processed in between aren't overwritten with what was read before.
+    lock = lock or threading.Lock()
+    with lock:
+        db.forum_feed.delete_many({'forum': _id})
+    query = forum_query(_id, forum)
+    if not query:
+        return 0
+    fields = {k: 1 for k in feed_fields}
+    count = 0
+    # Archived threads are still listed. Threads are only archived from
+    # `posts` to `posts_archive`, scanning them in that order sees them all.
+    for collection in [db.posts, db.posts_archive]:
+        page = query
+        while True:
+            with lock:
+                posts = list(collection.find(page, fields).sort('_id', 1).limit(batch_size))
+                if posts:
+                    db.forum_feed.bulk_write([
+                        UpdateOne({'_id': _id + '|' + post['_id']}, {'$set': feed_entry(_id, post)}, upsert=True) for post in posts
+                    ], ordered=False)
+            count += len(posts)
+            if len(posts) < batch_size:
+                break
+            page = {'$and': [query, {'_id': {'$gt': posts[-1]['_id']}}]}
+    return count
+
+
+def queue_rebuild(db, forum):
+    # The indexer rebuilds the forum's feed, counters and recent content once
+    # it has reloaded the forums (see process_forum_rebuilds), so no post is
+    # synced against the forum's old tags after its entries were recreated
+    db.forum_rebuilds.update({'_id': forum}, {
+        '$inc': {'version': 1},
+        '$setOnInsert': {'queued': datetime.utcnow()},
+    }, upsert=True)
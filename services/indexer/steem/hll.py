@@ -0,0 +1,34 @@
+import hashlib
+import math
+
+# HyperLogLog sketch for counting unique users in a fixed 4KB, with a
+# standard error of about 1.6%. Sketches merge by taking the maximum of each
+# register, so buckets for short periods combine into any longer window.
+
+precision = 12
+size = 1 << precision
+alpha = 0.7213 / (1 + 1.079 / size)
+
+
+class HyperLogLog(object):
+    def __init__(self, registers=None):
+        self.registers = bytearray(registers) if registers else bytearray(size)
+
+    def add(self, value):
+        hashed = int.from_bytes(hashlib.sha1(value.encode('utf-8')).digest()[:8], 'big')
+        idx = hashed >> (64 - precision)
+        rest = hashed & ((1 << (64 - precision)) - 1)
+        rank = (64 - precision) - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        estimate = alpha * size * size / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        # Linear counting is more accurate for small cardinalities
+        if estimate <= 2.5 * size and zeros:
+            return int(round(size * math.log(size / float(zeros))))
+        return int(round(estimate))
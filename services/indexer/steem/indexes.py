@@ -0,0 +1,44 @@
+# Indexes the indexer writes through, applied when the service starts.
+# create_index is a no-op for indexes that already exist.
+
+indexes = {
+    'activeusers_hll': [
+        # Buckets are dropped once past the longest window they're used in
+        ([('expires', 1)], {'expireAfterSeconds': 0}),
+        ([('granularity', 1), ('start', 1)], {}),
+    ],
+    'forum_feed': [
+        ([('post', 1)], {}),
+    ],
+    'forum_requests': [
+        # Reservations expire after an hour unless funded
+        ([('created', 1)], {'unique': True, 'name': 'created', 'expireAfterSeconds': 60*60}),
+    ],
+    'funding': [
+        ([('ns', 1), ('timestamp', -1)], {}),
+    ],
+    # Counted by the forum counter reconciliation, and archived by activity
+    'posts': [
+        ([('active', 1)], {}),
+        ([('category', 1), ('created', -1)], {}),
+        ([('namespace', 1), ('created', -1)], {}),
+    ],
+    'posts_archive': [
+        ([('category', 1)], {}),
+    ],
+    'replies': [
+        ([('category', 1), ('created', -1)], {}),
+        ([('root_namespace', 1), ('created', -1)], {}),
+        ([('root_post', 1), ('created', 1), ('_id', 1)], {}),
+    ],
+    'replies_archive': [
+        ([('category', 1)], {}),
+        ([('root_post', 1), ('created', 1), ('_id', 1)], {}),
+    ],
+}
+
+
+def ensure_indexes(db):
+    for collection, specs in sorted(indexes.items()):
+        for keys, options in specs:
+            db[collection].create_index(keys, **options)
@@ -15,6 +15,16 @@ from steem.converter import Converter
 from steem.steemd import Steemd
 from steem.utils import block_num_from_hash
 from bs4 import BeautifulSoup
+from activeusers import ActiveUsers
+from archive import Archive
+from backfill import Backfill, added, queue_backfill
+from content import collapse_votes, normalize, save_content, split_content, stored_update
+from counters import count_created, count_deleted, count_moderated, reconcile
+from events import emit_delete, emit_funding, emit_moderation, emit_post, emit_reply, emit_vote, ensure_events
+from feed import queue_rebuild, rebuild_forum_feed, remove_from_feed, update_feed
+from indexes import ensure_indexes
+from recent import add_recent, rebuild_recent, remove_recent, remove_thread_recent, restore_thread_recent
+from search import SearchIndex
 
 #########################################
 # Connections
@@ -42,12 +52,28 @@ mongo = MongoClient('mongodb://mongo')
 db = mongo[ns]
 
 # MongoDB Schema Enforcement
-if not 'forum_requests' in db.collection_names():
-    db.create_collection('forum_requests')
-request_index = 'created'
-request_collection = db.forum_requests
-if request_index not in request_collection.index_information():
-    request_collection.create_index('created', unique=True, name='created', expireAfterSeconds=60*60)
+ensure_indexes(db)
+ensure_events(db)
+
+# Unique active users per app, flushed to `activeusers_hll` periodically
+active_users = ActiveUsers(db, ns)
+
+# Full-text search index over posts, read by the REST service
+search_index = SearchIndex(os.environ['search_db'] if 'search_db' in os.environ else '/data/search.db')
+
+# Moves paid out, inactive threads into `posts_archive` and `replies_archive`
+archive = Archive(db, days=int(os.environ['archive_after_days']) if 'archive_after_days' in os.environ else 30)
+
+# Fetches the older posts of tags and accounts forums start listing, from the
+# full nodes (the tags api isn't on every node)
+backfill = Backfill(
+    db,
+    fn,
+    workers=int(os.environ['backfill_workers']) if 'backfill_workers' in os.environ else 8,
+    days=int(os.environ['backfill_days']) if 'backfill_days' in os.environ else 90,
+    search_index=search_index,
+    lock=archive.lock,
+)
 
 #########################################
 # Globals
@@ -73,6 +99,12 @@ vote_queue = []
 # Known Bots
 bots = set()
 
+# Set when new or deleted content changed a forum's counters or recent lists,
+# the REST registries are signalled at most every forums_version_interval
+# seconds rather than reloading all forums every block
+forums_changed = False
+forums_version_interval = int(os.environ['forums_version_interval']) if 'forums_version_interval' in os.environ else 10
+
 # ------------
 # If the indexer is behind more than the quick_value, it will:
 #
@@ -102,7 +134,19 @@ def l(msg):
 def sanitize(string):
     return BeautifulSoup(string, 'html.parser').get_text()
 
+def op_time(opData):
+    # When the op's block was produced. Events are timed by it, so the series
+    # rolled up from them stay right while the indexer catches up.
+    if 'timestamp' in opData:
+        return datetime.strptime(opData['timestamp'], '%Y-%m-%dT%H:%M:%S')
+    return None
+
 def process_op(op, block, quick=False):
+    # Threads aren't archived while an op is being processed
+    with archive.lock:
+        process_locked_op(op, block, quick)
+
+def process_locked_op(op, block, quick=False):
     # Split the array into type and data
     opType = op[0]
     opData = op[1]
@@ -179,6 +223,7 @@ def process_namespace_funding(opData):
     sufficient_funds = False
     # Record the funding event
     total = update_funding(opData)
+    emit_funding(db, opData['ns'], opData['from'], opData['steem_value'], opData['timestamp'])
     forum = db.forums.find_one({'_id': opData['ns']})
     if forum:
         # Store the funding value on the forum
@@ -189,6 +234,7 @@ def process_namespace_funding(opData):
                 'funded': total
             }
         })
+        bump_forums_version()
     else:
         request = db.forum_requests.find_one({'_id': opData['ns']})
         if request:
@@ -200,6 +246,7 @@ def process_namespace_funding(opData):
                 request.pop('expires', None)
                 request['funded'] = total
                 db.forums.insert(request)
+                bump_forums_version()
             else:
                 # If it's still under the threshold, update the request
                 db.forum_requests.update({
@@ -263,13 +310,21 @@ def process_forum_config(opData, custom_json):
             l('{} modifying settings for {} ({})'.format(operator, name, namespace))
             db.forums.update(query, {
                 '$set': {
-                    '_update': True,
                     'name': name,
                     'description': description,
                     'tags': tags,
                     'exclusive': exclusive,
                 }
             })
+            bump_forums_version()
+            queue_forum_stats(opData['namespace'])
+            # Tags may have changed, the following ops are synced against the
+            # new ones and the forum's feed is rebuilt off the block loop
+            rebuild_forums_cache()
+            before, forum = forum, db.forums.find_one(query)
+            queue_rebuild(db, forum['_id'])
+            # and fetch the history of any new tags
+            queue_backfill(db, forum['_id'], added(before, forum, 'tags'), added(before, forum, 'accounts'))
     except:
         pprint(custom_json)
         l('error processing')
@@ -301,23 +356,69 @@ def process_moderate_post(opData, custom_json):
     topic = opData['topic']
     if isModerator(moderator, forum):
         if 'remove' in opData:
-            db.forums.update({'_id': forum}, {'$set': {'_update': True}}) # Queue runnign stats update on the forum
+            archive.restore(topic)
+            queue_forum_stats(forum)
+            bump_forums_version()
             if opData['remove'] == True:
                 l('{} removed {} in {}'.format(moderator, topic, forum))
-                db.posts.update({'_id': topic}, {'$addToSet': {
+                previous = db.posts.find_one_and_update({'_id': topic}, {'$addToSet': {
                     '_removedFrom': forum
                 }})
+                replies = db.replies.count({'root_post': topic, '_removedFrom': {'$ne': forum}})
                 db.replies.update({'root_post': topic}, {'$addToSet': {
                     '_removedFrom': forum
-                }})
+                }}, multi=True)
+                if previous and forum not in previous.get('_removedFrom', []):
+                    count_moderated(db, forums_cache, forum, previous, replies, True)
+                    remove_thread_recent(db, forums_cache, forum, previous)
+                search_index.set_removed(topic, forum, True)
+                remove_from_feed(db, topic, forum)
+                emit_moderation(db, forum, topic, True, op_time(custom_json))
             if opData['remove'] == False:
                 l('{} restored {} in {}'.format(moderator, topic, forum))
-                db.posts.update({'_id': topic}, {'$pull': {
+                previous = db.posts.find_one_and_update({'_id': topic}, {'$pull': {
                     '_removedFrom': forum
                 }})
+                replies = db.replies.count({'root_post': topic, '_removedFrom': forum})
                 db.replies.update({'root_post': topic}, {'$pull': {
                     '_removedFrom': forum
-                }})
+                }}, multi=True)
+                if previous and forum in previous.get('_removedFrom', []):
+                    count_moderated(db, forums_cache, forum, previous, replies, False)
+                    restore_thread_recent(db, forums_cache, forum, previous)
+                search_index.set_removed(topic, forum, False)
+                post = db.posts.find_one({'_id': topic})
+                if post:
+                    update_feed(db, forums_cache, post)
+                emit_moderation(db, forum, topic, False, op_time(custom_json))
+
+def queue_forum_stats(forum):
+    # Queue a statistics update of the forum, see jobs.py in the statistics service
+    db.stats_jobs.update({'_id': 'forum:' + forum}, {
+        '$max': {'priority': 10},
+        '$inc': {'version': 1},
+        '$setOnInsert': {
+            'kind': 'forum',
+            'key': forum,
+            'queued': datetime.utcnow(),
+            'available': datetime.utcnow(),
+            'attempts': 0,
+        },
+    }, upsert=True)
+
+def bump_forums_version():
+    # Signals the REST forum registries to reload the forums
+    db.versions.update({'_id': 'forums'}, {'$inc': {'value': 1}}, upsert=True)
+
+def mark_forums_changed():
+    global forums_changed
+    forums_changed = True
+
+def flush_forums_version():
+    global forums_changed
+    if forums_changed:
+        forums_changed = False
+        bump_forums_version()
 
 def isModerator(user, forum):
     forum = db.forums.find_one({'_id': forum})
@@ -334,9 +435,17 @@ def remove_post(opData):
     _id = author + '/' + permlink
     l('post self-removed {}'.format(_id))
 
-    # Remove any matches
-    db.posts.remove({'_id': _id})
-    db.replies.remove({'_id': _id})
+    # Remove any matches, archived or not
+    archive.restore_comment(_id)
+    removed = db.posts.find_one_and_delete({'_id': _id}) or db.replies.find_one_and_delete({'_id': _id})
+    search_index.remove(_id)
+    remove_from_feed(db, _id)
+    db.content.delete_one({'_id': _id})
+    if removed:
+        changed = count_deleted(db, forums_cache, removed)
+        if remove_recent(db, forums_cache, removed) or changed:
+            mark_forums_changed()
+        emit_delete(db, forums_cache, removed, op_time(opData))
 
 
 def queue_parent_update(opData):
@@ -359,27 +468,8 @@ def queue_parent_update(opData):
 
 
 def load_post(_id, author, permlink):
-    # Fetch from the rpc
-    comment = s.get_content(author, permlink).copy()
-    # Add our ID
-    comment.update({
-        '_id': _id,
-    })
-    # Remap into our storage format
-    for key in ['abs_rshares', 'children_rshares2', 'net_rshares', 'children_abs_rshares', 'vote_rshares', 'total_vote_weight', 'root_comment', 'promoted', 'max_cashout_time', 'body_length', 'reblogged_by', 'replies']:
-        comment.pop(key, None)
-    for key in ['author_reputation']:
-        comment[key] = float(comment[key])
-    for key in ['total_pending_payout_value', 'pending_payout_value', 'max_accepted_payout', 'total_payout_value', 'curator_payout_value']:
-        comment[key] = float(comment[key].split()[0])
-    for key in ['active', 'created', 'cashout_time', 'last_payout', 'last_update']:
-        comment[key] = datetime.strptime(comment[key], '%Y-%m-%dT%H:%M:%S')
-    for key in ['json_metadata']:
-        try:
-            comment[key] = json.loads(comment[key])
-        except ValueError:
-            comment[key] = comment[key]
-    return comment
+    # Fetch from the rpc, in our storage format
+    return normalize(s.get_content(author, permlink), _id)
 
 
 def get_parent_post_id(reply):
@@ -411,17 +501,29 @@ def update_parent_post(parent_id, reply):
     query = {
         '_id': parent_id
     }
-    update = {
-        '$set': parent_post
-    }
-    db.posts.update(query, update)
-    return db.posts.find_one({'_id': parent_id})
+    stored, content = split_content(parent_post)
+    if db.posts.update(query, stored_update(stored))['n']:
+        save_content(db, [content])
+    parent_post = db.posts.find_one({'_id': parent_id})
+    if parent_post:
+        update_feed(db, forums_cache, parent_post)
+    return parent_post
 
 
 def update_indexes(comment):
     if comment['author'] not in bots:
         update_topics(comment)
-        update_forums(comment)
+
+
+def save_created(comment):
+    # A new post or reply, counted by its forums and listed among their
+    # recent content (unless posted by a bot)
+    changed = count_created(db, forums_cache, comment)
+    if comment['author'] not in bots:
+        changed = add_recent(db, forums_cache, comment) or changed
+    # Most comments are in no forum, the REST workers needn't reload them
+    if changed:
+        mark_forums_changed()
 
 
 def update_topics(comment):
@@ -453,114 +555,60 @@ def update_topics(comment):
     db.topics.update(query, {'$set': updates, }, upsert=True)
 
 
-def update_forums_last_post(index, comment):
-    # l('updating /forum/{} with post {}/{})'.format(index, comment['author'], comment['permlink']))
-    forum = db.forums.find_one({'_id': index})
-    if forum:
-        # If we have an exclusive flag
-        if 'exclusive' in forum and forum['exclusive'] == True:
-            # and the namespace of the post doesn't match the forum itself
-            if 'namespace' not in comment or comment['namespace'] != forum['_id']:
-                # don't update this forum
-                return
-        query = {
-            '_id': index,
-        }
-        updates = {
-            '_id': index,
-            'updated': comment['created'],
-            'last_post': {
-                'created': comment['created'],
-                'author': comment['author'],
-                'title': comment['title'],
-                'url': comment['url']
-            }
-        }
-        increments = {
-            'stats.posts': 1
-        }
-        db.forums.update(query, {'$set': updates, '$inc': increments}, upsert=True)
-
-
-def update_forums_last_reply(index, comment):
-    l('updating /forum/{} with post {}/{})'.format(index, comment['author'], comment['permlink']))
-    forum = db.forums.find_one({'_id': index})
-    if forum:
-        # If we have an exclusive flag
-        if 'exclusive' in forum and forum['exclusive'] == True:
-            # and the namespace of the post doesn't match the forum itself
-            if 'root_namespace' not in comment or comment['root_namespace'] != forum['_id']:
-                # don't update this forum
-                return
-        query = {
-            '_id': index,
-        }
-        updates = {
-            '_id': index,
-            'updated': comment['created'],
-            'last_reply': {
-                'created': comment['created'],
-                'author': comment['author'],
-                'title': comment['root_title'],
-                'url': comment['url']
-            }
-        }
-        increments = {
-            'stats.replies': 1
-        }
-        db.forums.update(query, {'$set': updates, '$inc': increments}, upsert=True)
-
-
-def update_forums(comment):
-    for index in forums_cache:
-        if ((
-            'tags' in forums_cache[index]
-            and
-            comment['category'] in forums_cache[index]['tags']
-        ) or (
-            'accounts' in forums_cache[index]
-            and
-            comment['author'] in forums_cache[index]['accounts']
-        )):
-            if comment['parent_author'] == '':
-                update_forums_last_post(index, comment)
-            else:
-                update_forums_last_reply(index, comment)
-
-
 def process_vote(_id, author, permlink):
     # Grab the parsed data of the post
     # l(_id)
     comment = load_post(_id, author, permlink)
-    # Ensure we a post was returned
-    if comment['author'] != '':
+    # Ensure we a post was returned, and that it wasn't archived meanwhile
+    with archive.lock:
+        if comment['author'] != '' and not archive.archived([_id]):
+            save_vote(_id, comment)
+
+
+def save_vote(_id, comment):
+    comment.update({
+        'active_votes': collapse_votes(comment['active_votes'])
+    })
+    # If this is a top level post, update the `posts` collection
+    if comment['parent_author'] == '':
+        save_post(_id, comment)
+        emit_vote(db, comment, _id)
+    # Otherwise save it into the `replies` collection and update the parent
+    else:
+        # A reply may be voted upon before its comment op was indexed, it's
+        # stored with its thread's fields as process_post stores it
+        root_post = get_parent_post_id(comment)
         comment.update({
-            'active_votes': collapse_votes(comment['active_votes'])
+            'parent_id': comment['parent_author'] + '/' + comment['parent_permlink'],
+            'root_post': root_post,
         })
-        # If this is a top level post, update the `posts` collection
-        if comment['parent_author'] == '':
-            db.posts.update({'_id': _id}, {'$set': comment}, upsert=True)
-        # Otherwise save it into the `replies` collection and update the parent
-        else:
-            # Update this post within the `replies` collection
-            db.replies.update({'_id': _id}, {'$set': comment}, upsert=True)
-
-
-def collapse_votes(votes):
-    collapsed = []
-    # Convert time to timestamps
-    for key, vote in enumerate(votes):
-        votes[key]['time'] = int(datetime.strptime(
-            votes[key]['time'], '%Y-%m-%dT%H:%M:%S').strftime('%s'))
-    # Sort based on time
-    sortedVotes = sorted(votes, key=lambda k: k['time'])
-    # Iterate and append to return value
-    for vote in votes:
-        collapsed.append([
-            vote['voter'],
-            vote['percent']
-        ])
-    return collapsed
+        # Update this post within the `replies` collection
+        previous = save_comment(db.replies, _id, comment, {'_id': 1})
+        if previous is None:
+            parent_post = db.posts.find_one({'_id': root_post}, {'namespace': 1})
+            comment['root_namespace'] = parent_post['namespace'] if parent_post and 'namespace' in parent_post else False
+            db.replies.update({'_id': _id}, {'$set': {'root_namespace': comment['root_namespace']}})
+            save_created(comment)
+        emit_vote(db, comment, root_post)
+
+
+def save_comment(collection, _id, comment, projection=None):
+    # Save into `posts` or `replies` with the body split out into `content`,
+    # returning the stored comment as it was before
+    stored, content = split_content(comment)
+    previous = collection.find_one_and_update({'_id': _id}, stored_update(stored), projection, upsert=True)
+    save_content(db, [content])
+    return previous
+
+
+def save_post(_id, comment):
+    # Save into `posts`, returning the stored post as it was before
+    previous = save_comment(db.posts, _id, comment)
+    # The stored post is the previous one with the new fields set
+    stored = dict(previous or {})
+    stored.update(comment)
+    update_feed(db, forums_cache, stored)
+    return previous
 
 
 def process_post(opData, block, quick=False):
@@ -582,15 +630,7 @@ def process_post(opData, block, quick=False):
     if isinstance(comment['json_metadata'], dict) and 'app' in comment['json_metadata'] and not quick:
         try:
             app = comment['json_metadata']['app'].split('/')[0]
-            db.activeusers.update({
-                '_id': comment['author']
-            }, {
-                '$set': {
-                    '_id': comment['author'],
-                    'ts': datetime.strptime(block['timestamp'], '%Y-%m-%dT%H:%M:%S')
-                },
-                '$addToSet': {'app': app},
-            }, upsert=True)
+            active_users.add(app, comment['author'], datetime.strptime(block['timestamp'], '%Y-%m-%dT%H:%M:%S'))
         except:
             pass
     # Collapse the votes
@@ -600,9 +640,16 @@ def process_post(opData, block, quick=False):
     try:
         # Ensure we a post was returned
         if comment['author'] != '':
+            # An archived thread is written to again, move it back first
+            archive.restore(_id if comment['parent_author'] == '' else get_parent_post_id(comment))
             # If this is a top level post, save into the `posts` collection
             if comment['parent_author'] == '':
-                db.posts.update({'_id': _id}, {'$set': comment}, upsert=True)
+                previous = save_post(_id, comment)
+                search_index.index(comment)
+                stored = dict(previous or {}, **comment)
+                if previous is None:
+                    save_created(stored)
+                emit_post(db, forums_cache, stored, edit=previous is not None, ts=op_time(opData))
             # Otherwise save it into the `replies` collection and update the parent
             else:
                 # Get the parent_id to update
@@ -611,11 +658,15 @@ def process_post(opData, block, quick=False):
                 parent_post = update_parent_post(parent_id, comment)
                 # Add data from the parent to this comment
                 comment.update({
+                    'parent_id': comment['parent_author'] + '/' + comment['parent_permlink'],
                     'root_post': parent_id,
                     'root_namespace': parent_post['namespace'] if parent_post and 'namespace' in parent_post else False,
                 })
                 # Update this post within the `replies` collection
-                db.replies.update({'_id': _id}, {'$set': comment}, upsert=True)
+                previous = save_comment(db.replies, _id, comment, {'_id': 1})
+                if previous is None:
+                    save_created(comment)
+                emit_reply(db, forums_cache, comment, parent_post, edit=previous is not None, ts=op_time(opData))
     except:
         l('Error parsing post')
         l(comment)
@@ -636,14 +687,76 @@ def rebuild_forums_cache():
             cache.update({'parent': forum['parent']})
         if 'tags' in forum and len(forum['tags']) > 0:
             cache.update({'tags': forum['tags']})
+        if 'exclusive' in forum:
+            cache.update({'exclusive': forum['exclusive']})
         forums_cache.update({str(forum['_id']): cache})
 
 
+def reconcile_counters():
+    # Correct any drift in the incrementally maintained forum counters
+    corrected = 0
+    for forum in db.forums.find():
+        # Nothing is counted by the block loop while a forum is recounted
+        with archive.lock:
+            stats = reconcile(db, forum['_id'], forum)
+        if stats:
+            l('corrected counts of {} to {}'.format(forum['_id'], stats))
+            corrected += 1
+    if corrected:
+        bump_forums_version()
+
+
+def process_forum_rebuilds():
+    # Forums whose tags or accounts changed, see queue_rebuild
+    jobs = list(db.forum_rebuilds.find().sort('queued', 1))
+    if not jobs:
+        return
+    # The config may have been applied by another process
+    with archive.lock:
+        rebuild_forums_cache()
+    for job in jobs:
+        forum = db.forums.find_one({'_id': job['_id']})
+        if forum:
+            count = rebuild_forum_feed(db, forum['_id'], forum, lock=archive.lock)
+            with archive.lock:
+                reconcile(db, forum['_id'], forum)
+                rebuild_recent(db, forum['_id'], forum)
+            l('rebuilt {} with {} posts'.format(forum['_id'], count))
+        # Unless it was queued again meanwhile
+        db.forum_rebuilds.remove({'_id': job['_id'], 'version': job['version']})
+    bump_forums_version()
+
+
+def process_forum_recounts():
+    # Forums queued by utils/reconcile_counters.py, see queue_recount
+    jobs = list(db.forum_recounts.find().sort('queued', 1))
+    if not jobs:
+        return
+    for job in jobs:
+        forum = db.forums.find_one({'_id': job['_id']})
+        if forum:
+            with archive.lock:
+                stats = reconcile(db, forum['_id'], forum)
+            if stats:
+                l('corrected counts of {} to {}'.format(forum['_id'], stats))
+        # Unless it was queued again meanwhile
+        db.forum_recounts.remove({'_id': job['_id'], 'version': job['version']})
+    bump_forums_version()
+
+
+def process_backfills():
+    # The forums of finished jobs are rebuilt by process_forum_rebuilds
+    backfill.run()
+
+
 def process_vote_queue():
     global vote_queue
     # l('Updating {} posts that were voted upon.'.format(len(vote_queue)))
-    # Process all queued votes from block
+    # Process all queued votes from block, but archived content's
+    archived = archive.archived(vote_queue) if vote_queue else set()
     for _id in vote_queue:
+        if _id in archived:
+            continue
         # Split the ID into parameters for loading the post
         author, permlink = _id.split('/')
         # Process the votes
@@ -721,12 +834,22 @@ if __name__ == '__main__':
     rebuild_forums_cache()
     rebuild_bots_cache()
 
+    # The version used to be a status document, which REST returns to clients
+    db.status.remove({'_id': 'forums_version'})
+
     scheduler = BackgroundScheduler()
     scheduler.add_job(process_global_props, 'interval', seconds=9, id='process_global_props')
     scheduler.add_job(rebuild_forums_cache, 'interval', minutes=1, id='rebuild_forums_cache')
     scheduler.add_job(rebuild_bots_cache, 'interval', minutes=1, id='rebuild_bots_cache')
     scheduler.add_job(process_vote_queue, 'interval', seconds=15, id='process_vote_queue')
     scheduler.add_job(process_rewards_pools, 'interval', minutes=10, id='process_rewards_pools')
+    scheduler.add_job(active_users.flush, 'interval', seconds=30, id='flush_active_users')
+    scheduler.add_job(reconcile_counters, 'interval', hours=24, id='reconcile_counters')
+    scheduler.add_job(process_backfills, 'interval', minutes=1, id='process_backfills')
+    scheduler.add_job(process_forum_rebuilds, 'interval', seconds=10, id='process_forum_rebuilds')
+    scheduler.add_job(process_forum_recounts, 'interval', seconds=10, id='process_forum_recounts')
+    scheduler.add_job(archive.run, 'interval', hours=1, id='archive_threads')
+    scheduler.add_job(flush_forums_version, 'interval', seconds=forums_version_interval, id='flush_forums_version')
     scheduler.start()
 
     quick = False
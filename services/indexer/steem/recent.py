@@ -0,0 +1,152 @@
+from pymongo import ReturnDocument
+
+from counters import counted_in, reply_query
+from feed import forum_matches, forum_query
+
+# Each forum keeps its most recent posts and replies in `recent_posts` and
+# `recent_replies`, newest first, and the head of each as `last_post` and
+# `last_reply`. New content is pushed in as it's indexed and removed content
+# pulled out, so when a moderator removes the latest post the next one is
+# promoted without a query. Only a list that runs empty is refilled.
+
+recent_size = 10
+
+fields = {
+    False: ('recent_posts', 'last_post'),
+    True: ('recent_replies', 'last_reply'),
+}
+
+
+def is_reply(comment):
+    return bool(comment.get('parent_author'))
+
+
+def summary(comment):
+    entry = {
+        '_id': comment['_id'],
+        'created': comment['created'],
+        'author': comment['author'],
+        'title': comment['root_title'] if is_reply(comment) else comment['title'],
+        'url': comment['url'],
+    }
+    if is_reply(comment):
+        entry['root_post'] = comment['root_post']
+    return entry
+
+
+def head(entries):
+    # The shape of last_post and last_reply
+    if not entries:
+        return {}
+    return {k: entries[0][k] for k in ['created', 'author', 'title', 'url']}
+
+
+def push(db, forum, reply, entries):
+    # Merge entries into a forum's list, returns whether its head changed
+    field, last = fields[reply]
+    ids = [entry['_id'] for entry in entries]
+    doc = db.forums.find_one_and_update({'_id': forum}, {'$pull': {field: {'_id': {'$in': ids}}}}, {field: 1})
+    if doc is None:
+        return False
+    before = doc.get(field, [])
+    doc = db.forums.find_one_and_update({'_id': forum}, {'$push': {field: {
+        '$each': entries,
+        '$sort': {'created': -1},
+        '$slice': recent_size,
+    }}}, {field: 1}, return_document=ReturnDocument.AFTER)
+    after = doc.get(field, [])
+    if head(after) != head(before):
+        updates = {last: head(after)}
+        if after:
+            updates['updated'] = after[0]['created']
+        db.forums.update({'_id': forum}, {'$set': updates})
+        return True
+    return False
+
+
+def pull(db, forum_id, forum, reply, query):
+    # Remove entries from a forum's list, returns whether its head changed
+    field, last = fields[reply]
+    doc = db.forums.find_one_and_update({'_id': forum_id}, {'$pull': {field: query}}, {field: 1})
+    if doc is None:
+        return False
+    before = doc.get(field, [])
+    after = [entry for entry in before if any(entry.get(k) != v for k, v in query.items())]
+    if before and not after:
+        # Everything known was removed, look further back
+        return refill(db, forum_id, forum, reply)
+    if head(after) != head(before):
+        db.forums.update({'_id': forum_id}, {'$set': {last: head(after)}})
+        return True
+    return False
+
+
+def bot_names(db):
+    return [str(bot['_id']) for bot in db.bots.find({}, {'_id': 1})]
+
+
+def latest(db, _id, forum, reply):
+    # A forum's list as queried from the stored content, with its head.
+    # Bots' content is left out, as the indexer doesn't push it either.
+    field, last = fields[reply]
+    query = reply_query(_id, forum) if reply else forum_query(_id, forum)
+    entries = []
+    if query:
+        bots = bot_names(db)
+        if bots:
+            query = {'$and': [query, {'author': {'$nin': bots}}]}
+        collection = db.replies if reply else db.posts
+        entries = [summary(comment) for comment in collection.find(query).sort([('created', -1)]).limit(recent_size)]
+    return {field: entries, last: head(entries)}
+
+
+def refill(db, _id, forum, reply):
+    db.forums.update({'_id': _id}, {'$set': latest(db, _id, forum, reply)})
+    return True
+
+
+def recent_lists(db, _id, forum):
+    # Both lists of a forum, as the fields to set
+    lists = latest(db, _id, forum, False)
+    lists.update(latest(db, _id, forum, True))
+    return lists
+
+
+def rebuild_recent(db, _id, forum):
+    # Recreate both lists of a forum, ie: after its tags or accounts changed
+    db.forums.update({'_id': _id}, {'$set': recent_lists(db, _id, forum)})
+
+
+def add_recent(db, forums, comment):
+    # A new post or reply, returns whether any forum's head changed
+    changed = False
+    for forum in counted_in(forums, comment):
+        changed = push(db, forum, is_reply(comment), [summary(comment)]) or changed
+    return changed
+
+
+def remove_recent(db, forums, comment):
+    # A deleted post or reply
+    changed = False
+    for forum in counted_in(forums, comment):
+        changed = pull(db, forum, forums[forum], is_reply(comment), {'_id': comment['_id']}) or changed
+    return changed
+
+
+def remove_thread_recent(db, forums, forum, post):
+    # A moderator removed the thread from the forum
+    if forum not in forums or not forum_matches(forum, forums[forum], post):
+        return False
+    changed = pull(db, forum, forums[forum], False, {'_id': post['_id']})
+    return pull(db, forum, forums[forum], True, {'root_post': post['_id']}) or changed
+
+
+def restore_thread_recent(db, forums, forum, post):
+    # A moderator restored the thread, it's back if still among the latest
+    if forum not in forums or not forum_matches(forum, forums[forum], post):
+        return False
+    changed = push(db, forum, False, [summary(post)])
+    replies = [summary(reply) for reply in db.replies.find({'root_post': post['_id']}).sort([('created', -1)]).limit(recent_size)]
+    if replies:
+        changed = push(db, forum, True, replies) or changed
+    return changed
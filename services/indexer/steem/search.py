@@ -0,0 +1,90 @@
+import sqlite3
+
+# Posts are stored in a plain table, with an external content FTS5 index over
+# title + body kept in sync by triggers. Moderation is tracked separately so
+# removing/restoring a post never touches the text index.
+schema = [
+    '''CREATE TABLE IF NOT EXISTS documents (
+        rowid INTEGER PRIMARY KEY,
+        id TEXT UNIQUE NOT NULL,
+        category TEXT,
+        namespace TEXT,
+        author TEXT,
+        title TEXT,
+        body TEXT,
+        url TEXT,
+        created TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS documents_category ON documents (category)',
+    'CREATE INDEX IF NOT EXISTS documents_namespace ON documents (namespace)',
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(
+        title, body, content='documents', content_rowid='rowid', tokenize='porter unicode61'
+    )''',
+    '''CREATE TRIGGER IF NOT EXISTS documents_ai AFTER INSERT ON documents BEGIN
+        INSERT INTO search (rowid, title, body) VALUES (new.rowid, new.title, new.body);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS documents_ad AFTER DELETE ON documents BEGIN
+        INSERT INTO search (search, rowid, title, body) VALUES ('delete', old.rowid, old.title, old.body);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS documents_au AFTER UPDATE ON documents BEGIN
+        INSERT INTO search (search, rowid, title, body) VALUES ('delete', old.rowid, old.title, old.body);
+        INSERT INTO search (rowid, title, body) VALUES (new.rowid, new.title, new.body);
+    END''',
+    '''CREATE TABLE IF NOT EXISTS removed (
+        post_id TEXT NOT NULL,
+        forum TEXT NOT NULL,
+        PRIMARY KEY (post_id, forum)
+    )''',
+]
+
+
+class SearchIndex(object):
+    # Written to by the indexer only, the REST service opens it to read
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in schema:
+            self.conn.execute(statement)
+        self.conn.commit()
+
+    def index(self, post, commit=True):
+        values = (
+            post.get('category'),
+            post.get('namespace'),
+            post['author'],
+            post['title'],
+            post['body'],
+            post['url'],
+            post['created'].strftime('%Y-%m-%dT%H:%M:%S'),
+            post['_id'],
+        )
+        cursor = self.conn.execute('''UPDATE documents
+            SET category = ?, namespace = ?, author = ?, title = ?, body = ?, url = ?, created = ?
+            WHERE id = ?''', values)
+        if cursor.rowcount == 0:
+            self.conn.execute('''INSERT INTO documents
+                (category, namespace, author, title, body, url, created, id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', values)
+        # Posts loaded from mongo carry their moderation state with them
+        if '_removedFrom' in post:
+            self.conn.execute('DELETE FROM removed WHERE post_id = ?', (post['_id'],))
+            for forum in post['_removedFrom']:
+                self.conn.execute('INSERT INTO removed (post_id, forum) VALUES (?, ?)', (post['_id'], forum))
+        if commit:
+            self.conn.commit()
+
+    def remove(self, _id):
+        self.conn.execute('DELETE FROM documents WHERE id = ?', (_id,))
+        self.conn.execute('DELETE FROM removed WHERE post_id = ?', (_id,))
+        self.conn.commit()
+
+    def set_removed(self, _id, forum, removed):
+        if removed:
+            self.conn.execute('INSERT OR IGNORE INTO removed (post_id, forum) VALUES (?, ?)', (_id, forum))
+        else:
+            self.conn.execute('DELETE FROM removed WHERE post_id = ? AND forum = ?', (_id, forum))
+        self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
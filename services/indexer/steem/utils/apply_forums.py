@@ -0,0 +1,142 @@
+from pymongo import DeleteOne, MongoClient, UpdateOne
+import json
+import os
+import re
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from backfill import added, queue_backfill
+from feed import queue_rebuild
+
+# Applies a whole forum configuration in one process: the definitions are
+# diffed against the stored forums, only what changed is written (in one bulk
+# write), and only the forums whose tags, accounts or exclusivity changed get
+# their feed, counters and latest content rebuilt. The indexer does those
+# rebuilds once it has reloaded the forums (see queue_rebuild).
+#
+#   python3 apply_forums.py [--dry-run] [--prune] defaults.json [...]
+#
+# Reads the `var schema = [...]` files (like defaults.json) as well as the
+# shell scripts of `python3 reindex.py '<json>'` calls (like defaults_steem).
+# With --prune, forums that aren't defined in any of the files are removed.
+# With --dry-run, the changes are only listed.
+#
+# Tags and accounts a forum didn't list before are queued for the indexer to
+# backfill their older posts (see backfill.py).
+
+ns = os.environ['namespace'] if 'namespace' in os.environ else 'chainbb'
+mongo = MongoClient('mongodb://mongo')
+db = mongo[ns]
+
+# The fields that decide which content a forum lists
+membership = ['tags', 'accounts', 'exclusive']
+
+
+def load_definitions(path):
+    with open(path) as f:
+        text = f.read()
+    calls = re.findall(r"reindex\.py\s+'(.*?)'", text, re.S)
+    if calls:
+        return [json.loads(call) for call in calls]
+    return json.loads(text[text.index('['):text.rindex(']') + 1])
+
+
+def children_of(definitions, current):
+    # The children of every parent once the definitions are applied, the
+    # defined forums in the order they're defined
+    defined = {definition['_id']: definition for definition in definitions}
+    order = [definition['_id'] for definition in definitions]
+    order += sorted(_id for _id in current if _id not in defined)
+    children = {}
+    for _id in order:
+        forum = defined[_id] if _id in defined else current[_id]
+        if forum.get('parent'):
+            children.setdefault(forum['parent'], []).append({'_id': _id, 'name': forum.get('name')})
+    return children
+
+
+def same_children(a, b):
+    return sorted(a or [], key=lambda child: child['_id']) == sorted(b or [], key=lambda child: child['_id'])
+
+
+def plan(definitions, current, prune=False):
+    # The writes to apply, as {_id: {'$set': {}, '$unset': {}}}, the forums
+    # to rebuild and the forums to remove
+    defined = {definition['_id']: definition for definition in definitions}
+    names = {_id: forum.get('name') for _id, forum in current.items()}
+    names.update({_id: definition.get('name') for _id, definition in defined.items()})
+    children = children_of(definitions, {} if prune else current)
+    updates = {}
+    rebuild = []
+    for _id in sorted(set(defined) | set(current)):
+        if _id not in defined and prune:
+            continue
+        forum = current.get(_id, {})
+        update = {'$set': {}, '$unset': {}}
+        if _id in defined:
+            definition = dict(defined[_id])
+            if definition.get('parent'):
+                if definition['parent'] not in names:
+                    print('[FORUM][APPLY] - Unknown parent [{}] of [{}]'.format(definition['parent'], _id))
+                definition['parent_name'] = names.get(definition['parent'])
+            else:
+                definition.pop('parent', None)
+                update['$unset'].update({k: True for k in ['parent', 'parent_name'] if k in forum})
+            update['$set'].update({k: v for k, v in definition.items() if k != '_id' and forum.get(k) != v})
+        if not same_children(children.get(_id), forum.get('children')):
+            if children.get(_id):
+                update['$set']['children'] = children[_id]
+            else:
+                update['$unset']['children'] = True
+        update = {op: fields for op, fields in update.items() if fields}
+        if update:
+            updates[_id] = update
+        if _id not in current or any(k in update.get('$set', {}) for k in membership):
+            rebuild.append(_id)
+    removed = sorted(set(current) - set(defined)) if prune else []
+    return updates, rebuild, removed
+
+
+def apply(definitions, dry_run=False, prune=False):
+    current = {forum['_id']: forum for forum in db.forums.find()}
+    updates, rebuild, removed = plan(definitions, current, prune)
+    for _id, update in sorted(updates.items()):
+        action = 'Updating forum' if _id in current else 'Inserting new forum'
+        fields = sorted(set(update.get('$set', {})) | set(update.get('$unset', {})))
+        print('[FORUM][APPLY] - {} [{}]: {}'.format(action, _id, ', '.join(fields)))
+    for _id in rebuild:
+        print('[FORUM][APPLY] - Queueing a rebuild of the feed, counters and latest content of [{}]'.format(_id))
+    for _id in removed:
+        print('[FORUM][APPLY] - Removing forum [{}]'.format(_id))
+    backfills = {}
+    for _id in rebuild:
+        after = dict(current.get(_id, {}), **updates.get(_id, {}).get('$set', {}))
+        backfills[_id] = (added(current.get(_id, {}), after, 'tags'), added(current.get(_id, {}), after, 'accounts'))
+        if backfills[_id][0] or backfills[_id][1]:
+            print('[FORUM][APPLY] - Backfilling [{}]: {}'.format(_id, ', '.join(backfills[_id][0] + backfills[_id][1])))
+    if dry_run or not (updates or removed):
+        return updates, rebuild, removed
+    ops = [UpdateOne({'_id': _id}, update, upsert=True) for _id, update in updates.items()]
+    ops += [DeleteOne({'_id': _id}) for _id in removed]
+    db.forums.bulk_write(ops, ordered=False)
+    if removed:
+        db.forum_feed.delete_many({'forum': {'$in': removed}})
+    for _id in rebuild:
+        queue_rebuild(db, _id)
+    for _id, (tags, accounts) in backfills.items():
+        queue_backfill(db, _id, tags, accounts)
+    # Signal the REST forum registries to reload the forums
+    db.versions.update({'_id': 'forums'}, {'$inc': {'value': 1}}, upsert=True)
+    return updates, rebuild, removed
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if not args:
+        print('usage: python3 apply_forums.py [--dry-run] [--prune] file [...]')
+        sys.exit(1)
+    definitions = []
+    for path in args:
+        definitions += load_definitions(path)
+    apply(definitions, dry_run='--dry-run' in sys.argv, prune='--prune' in sys.argv)
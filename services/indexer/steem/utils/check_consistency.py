@@ -0,0 +1,258 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from pymongo import MongoClient, UpdateOne
+from steem import Steem
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from content import amount_fields, collapse_votes, content_op, normalize, split_content, stored_update
+from counters import count_deleted
+from feed import remove_from_feed, update_feed
+from recent import remove_recent
+from search import SearchIndex
+
+# Compares indexed posts and replies against the chain, to find what drifted
+# (an exception swallowed while indexing, votes skipped in quick mode, a crash
+# between writes), and repairs it with --repair.
+#
+#   python3 check_consistency.py [sample_size | --all] [--repair]
+#
+# Checks a random sample of the posts and replies (1000 by default) or all of
+# them, created within the last check_since_days if set. They're refetched
+# from the node by check_workers threads, at most check_rate requests per
+# second so it can run next to the indexer. Differences in payouts, votes,
+# reply counts and edits are reported, as are comments deleted on chain and
+# replies whose moderation (_removedFrom) differs from their thread's.
+#
+# Archived threads aren't refetched once paid out (see archive.py), their
+# payouts and cashout_time are left out of the comparison.
+#
+# The indexer keeps running meanwhile, so a comment is only repaired if it's
+# still as it was sampled: one the indexer saved since (a vote, an edit, a
+# reply) is skipped, it's already newer than what was fetched. The rest goes
+# through the same helpers as the indexer's: a deleted comment
+# (and a deleted post's replies) leaves the forums' counters, feeds, recent
+# lists and the search index, and a drifted post is written to its feeds and
+# reindexed. Run it where the indexer's search_db is mounted.
+#
+# The summary of the last run is saved in `consistency` as `last`.
+
+ns = os.environ['namespace'] if 'namespace' in os.environ else 'chainbb'
+mongo = MongoClient('mongodb://mongo')
+db = mongo[ns]
+
+search_index = SearchIndex(os.environ['search_db'] if 'search_db' in os.environ else '/data/search.db')
+
+nodes = [
+    os.environ['steem_node'] if 'steem_node' in os.environ else 'https://api.steemit.com',
+]
+s = Steem(nodes)
+
+workers = int(os.environ['check_workers']) if 'check_workers' in os.environ else 4
+rate = float(os.environ['check_rate']) if 'check_rate' in os.environ else 10
+since_days = int(os.environ['check_since_days']) if 'check_since_days' in os.environ else 0
+batch_size = 100
+
+compared_fields = ['children', 'last_update', 'net_votes', 'cashout_time']
+# Only set by the rpc until the thread is paid out and archived
+archived_fields = amount_fields + ['cashout_time']
+# Whatever the indexer saves changes one of these, see sampled()
+saved_fields = ['active', 'active_votes', 'children', 'last_update', 'net_votes']
+# Pending payouts move with every vote and the reward pool, they only count
+# as drift beyond this share of the value
+pending_tolerance = 0.05
+
+
+def l(msg):
+    print('[FORUM][CONSISTENCY] {}'.format(msg))
+    sys.stdout.flush()
+
+
+class RateLimiter(object):
+    # Spaces calls out to at most `rate` per second, across threads
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next = time.time()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next - now
+            self.next = max(now, self.next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+limiter = RateLimiter(rate)
+
+
+def fetch(_id):
+    limiter.wait()
+    author, permlink = _id.split('/', 1)
+    comment = normalize(s.get_content(author, permlink), _id)
+    if comment['author'] != '':
+        comment['active_votes'] = collapse_votes(comment['active_votes'])
+    return comment
+
+
+def differs(field, stored, fresh):
+    if field.startswith('pending') or field.startswith('total_pending'):
+        return abs(stored - fresh) > max(0.001, pending_tolerance * max(abs(stored), abs(fresh)))
+    if field in amount_fields:
+        return abs(stored - fresh) > 0.001
+    return stored != fresh
+
+
+def diff(stored, fresh, archived=False):
+    # The fields that drifted, as {field: (indexed, on chain)}
+    if fresh['author'] == '':
+        return {'deleted': (False, True)}
+    drift = {}
+    for field in amount_fields + compared_fields:
+        if archived and field in archived_fields:
+            continue
+        if field in fresh and differs(field, stored.get(field, 0), fresh[field]):
+            drift[field] = (stored.get(field), fresh[field])
+    votes = dict((voter, percent) for voter, percent in stored.get('active_votes', []))
+    fresh_votes = dict((voter, percent) for voter, percent in fresh['active_votes'])
+    if votes != fresh_votes:
+        drift['active_votes'] = (len(votes), len(fresh_votes))
+    return drift
+
+
+def sampled(doc):
+    # Matches the comment only if the indexer hasn't saved it since `doc` was
+    # read (a missing field matches None)
+    query = {'_id': doc['_id']}
+    for field in saved_fields:
+        query[field] = doc.get(field)
+    return query
+
+
+def moderation_drift(collection, posts):
+    # Replies whose _removedFrom isn't their thread's, as {reply id: (reply's, thread's)}
+    removed = {post['_id']: sorted(post.get('_removedFrom', [])) for post in posts}
+    drift = {}
+    for reply in collection.find({'root_post': {'$in': list(removed)}}, {'root_post': 1, '_removedFrom': 1}):
+        expected = removed[reply['root_post']]
+        if sorted(reply.get('_removedFrom', [])) != expected:
+            drift[reply['_id']] = (reply.get('_removedFrom'), expected)
+    return drift
+
+
+def documents(collection, sample_size):
+    query = {'created': {'$gte': datetime.utcnow() - timedelta(days=since_days)}} if since_days else {}
+    fields = {'body': 0}
+    if sample_size:
+        return collection.aggregate([{'$match': query}, {'$sample': {'size': sample_size}}, {'$project': fields}])
+    return collection.find(query, fields).batch_size(batch_size)
+
+
+def check_batch(pool, collection, replies, batch, repair, summary, archived=False):
+    fresh = dict(zip([doc['_id'] for doc in batch], pool.map(fetch, [doc['_id'] for doc in batch])))
+    deleted = []
+    drifted = []
+    for doc in batch:
+        drift = diff(doc, fresh[doc['_id']], archived)
+        for field, (indexed, chain) in sorted(drift.items()):
+            summary['drifted'][field] = summary['drifted'].get(field, 0) + 1
+            l('{} {}: {} indexed, {} on chain'.format(doc['_id'], field, indexed, chain))
+        if drift:
+            summary['comments'] += 1
+            if 'deleted' in drift:
+                deleted.append(doc)
+            else:
+                drifted.append(doc)
+    moderation = {}
+    if replies is not None:
+        moderation = moderation_drift(replies, batch)
+        for _id, (current, expected) in sorted(moderation.items()):
+            summary['drifted']['_removedFrom'] = summary['drifted'].get('_removedFrom', 0) + 1
+            l('{} _removedFrom: should be {} like its thread'.format(_id, expected))
+    if not repair:
+        return
+    # Written one at a time, to know which were still as sampled
+    contents = []
+    for doc in list(drifted):
+        stored, content = split_content(fresh[doc['_id']])
+        if collection.update_one(sampled(doc), stored_update(stored)).matched_count:
+            contents.append(content_op(content))
+        else:
+            l('{} was saved by the indexer meanwhile, skipped'.format(doc['_id']))
+            drifted.remove(doc)
+            summary['skipped'] += 1
+    if contents:
+        db.content.bulk_write(contents, ordered=False)
+    forums = {str(forum['_id']): forum for forum in db.forums.find()}
+    if replies is not None:
+        # Posts, as the indexer saves them after an edit
+        for doc in drifted:
+            post = dict(doc, **fresh[doc['_id']])
+            update_feed(db, forums, post)
+            search_index.index(post)
+    summary['repaired'] += len(drifted) + len(deleted)
+    if deleted:
+        collection.delete_many({'_id': {'$in': [doc['_id'] for doc in deleted]}})
+        # A deleted post takes its replies with it
+        if replies is not None:
+            orphans = list(replies.find({'root_post': {'$in': [doc['_id'] for doc in deleted]}}, {'body': 0}))
+            if orphans:
+                replies.delete_many({'_id': {'$in': [reply['_id'] for reply in orphans]}})
+                deleted += orphans
+        db.content.delete_many({'_id': {'$in': [doc['_id'] for doc in deleted]}})
+        for doc in deleted:
+            search_index.remove(doc['_id'])
+            remove_from_feed(db, doc['_id'])
+            count_deleted(db, forums, doc)
+            remove_recent(db, forums, doc)
+        summary['deleted'] += len(deleted)
+    if moderation:
+        # Unless a moderator changed the reply meanwhile
+        result = replies.bulk_write([
+            UpdateOne({'_id': _id, '_removedFrom': current}, {'$set': {'_removedFrom': expected}})
+            for _id, (current, expected) in moderation.items()
+        ], ordered=False)
+        summary['repaired'] += result.modified_count
+
+
+def check(sample_size, repair=False):
+    summary = {'checked': 0, 'comments': 0, 'drifted': {}, 'repaired': 0, 'skipped': 0, 'deleted': 0, 'started': datetime.utcnow()}
+    # Archived threads are checked too, their replies are in the same tier
+    tiers = [
+        (db.posts, db.replies, False),
+        (db.replies, None, False),
+        (db.posts_archive, db.replies_archive, True),
+        (db.replies_archive, None, True),
+    ]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for collection, replies, archived in tiers:
+            batch = []
+            for doc in documents(collection, sample_size):
+                batch.append(doc)
+                if len(batch) >= batch_size:
+                    check_batch(pool, collection, replies, batch, repair, summary, archived)
+                    summary['checked'] += len(batch)
+                    batch = []
+            if batch:
+                check_batch(pool, collection, replies, batch, repair, summary, archived)
+                summary['checked'] += len(batch)
+            l('checked {} so far, {} drifted'.format(summary['checked'], summary['comments']))
+    if summary['deleted']:
+        # The forums' counters changed
+        db.versions.update({'_id': 'forums'}, {'$inc': {'value': 1}}, upsert=True)
+    summary['finished'] = datetime.utcnow()
+    # Not in `status`, every document there is served as part of the network
+    db.consistency.update({'_id': 'last'}, {'$set': summary}, upsert=True)
+    l('done: {checked} checked, {comments} drifted, {repaired} repaired, {skipped} skipped'.format(**summary))
+    return summary
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    sample_size = None if '--all' in sys.argv else int(args[0]) if args else 1000
+    check(sample_size, repair='--repair' in sys.argv)
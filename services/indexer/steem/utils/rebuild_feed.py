@@ -0,0 +1,24 @@
+from pymongo import MongoClient
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from feed import rebuild_forum_feed
+
+# Builds the `forum_feed` entries of every forum (or only those passed in)
+# from the posts already indexed.
+#
+#   python3 rebuild_feed.py [forum_id ...]
+
+ns = os.environ['namespace'] if 'namespace' in os.environ else 'chainbb'
+mongo = MongoClient('mongodb://mongo')
+db = mongo[ns]
+
+if __name__ == '__main__':
+    query = {}
+    if len(sys.argv) > 1:
+        query['_id'] = {'$in': sys.argv[1:]}
+    for forum in db.forums.find(query):
+        count = rebuild_forum_feed(db, forum['_id'], forum)
+        print('[FORUM][FEED] - {} entries for [{}]'.format(count, forum['_id']))
@@ -0,0 +1,50 @@
+from itertools import chain
+from pymongo import MongoClient
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from content import load_bodies
+from search import SearchIndex
+
+# Builds (or refreshes) the search index from every post already in mongo,
+# archived or not.
+#
+#   python3 rebuild_search.py [/path/to/search.db]
+
+ns = os.environ['namespace'] if 'namespace' in os.environ else 'chainbb'
+mongo = MongoClient('mongodb://mongo')
+db = mongo[ns]
+
+path = sys.argv[1] if len(sys.argv) > 1 else os.environ['search_db'] if 'search_db' in os.environ else '/data/search.db'
+
+if __name__ == '__main__':
+    index = SearchIndex(path)
+    fields = {
+        'author': 1,
+        'body': 1,
+        'category': 1,
+        'created': 1,
+        'namespace': 1,
+        'title': 1,
+        'url': 1,
+        '_removedFrom': 1,
+    }
+    def index_batch(posts):
+        # Posts stored before the bodies were split out still have theirs
+        bodies = load_bodies(db, [post['_id'] for post in posts if 'body' not in post])
+        for post in posts:
+            post.setdefault('_removedFrom', [])
+            post.setdefault('body', bodies.get(post['_id'], ''))
+            index.index(post, commit=False)
+        index.commit()
+    batch = []
+    for idx, post in enumerate(chain(db.posts.find({}, fields), db.posts_archive.find({}, fields))):
+        batch.append(post)
+        if len(batch) == 1000:
+            index_batch(batch)
+            batch = []
+            print('[FORUM][SEARCH] - {} posts indexed'.format(idx + 1))
+    index_batch(batch)
+    print('[FORUM][SEARCH] - Done')
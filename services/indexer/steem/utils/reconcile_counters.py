@@ -0,0 +1,26 @@
+from pymongo import MongoClient
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from counters import queue_recount
+
+# Queues a recount of the posts and replies of every forum (or only those
+# passed in), correcting the counters the indexer maintains if they drifted.
+# The running indexer recounts them under its op lock, counting here would
+# race with it.
+#
+#   python3 reconcile_counters.py [forum_id ...]
+
+ns = os.environ['namespace'] if 'namespace' in os.environ else 'chainbb'
+mongo = MongoClient('mongodb://mongo')
+db = mongo[ns]
+
+if __name__ == '__main__':
+    query = {}
+    if len(sys.argv) > 1:
+        query['_id'] = {'$in': sys.argv[1:]}
+    for forum in db.forums.find(query):
+        queue_recount(db, forum['_id'])
+        print('[FORUM][COUNTERS] - queued [{}]'.format(forum['_id']))
@@ -0,0 +1,177 @@
+from bson import BSON, decode_all
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from pymongo import MongoClient
+import gzip
+import json
+import os
+import sys
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from counters import reconcile
+
+# Exports the namespace's collections to a snapshot directory, and imports
+# them into an empty database, so a new node starts from the snapshot's
+# height instead of replaying the chain from the first block.
+#
+#   python3 snapshot.py export /path/to/snapshot
+#   python3 snapshot.py import /path/to/snapshot [--drop]
+#
+# A snapshot is a manifest.json and, for each collection, numbered chunks of
+# gzipped BSON (<collection>.<n>.bson.gz, readable with zcat | bsondump).
+# Collections are read in parallel, and chunks compressed and written (or
+# read and inserted) by a pool of snapshot_workers threads. Indexes are
+# created once the documents are loaded.
+#
+# The status checkpoints are read before anything else, so while the indexer
+# keeps running during an export the snapshot may hold content past its
+# height, which the indexer replays over when it resumes from there. Saving
+# posts, replies, feeds and recent lists again is harmless, but the forums'
+# counters are incremented for every post created (see counters.py) and may
+# already include some of those posts, so the import recounts every forum.
+# Activity rolled up from the replayed blocks (timeseries) can count twice.
+#
+# The capped `events` log isn't exported, the indexer recreates it. The
+# search index lives outside of mongo, run rebuild_search.py after an import.
+
+ns = os.environ['namespace'] if 'namespace' in os.environ else 'chainbb'
+mongo = MongoClient('mongodb://mongo')
+db = mongo[ns]
+
+workers = int(os.environ['snapshot_workers']) if 'snapshot_workers' in os.environ else 4
+chunk_size = int(os.environ['snapshot_chunk_size']) if 'snapshot_chunk_size' in os.environ else 10000
+
+excluded = ['events']
+checkpoints = ['height_processed', 'history_processed']
+
+# index_information() fields that aren't create_index options
+index_fields = ['key', 'ns', 'v']
+
+
+def l(msg):
+    print('[FORUM][SNAPSHOT] {}'.format(msg))
+    sys.stdout.flush()
+
+
+def chunk_path(path, collection, number):
+    return os.path.join(path, '{}.{}.bson.gz'.format(collection, number))
+
+
+def write_chunk(path, docs):
+    data = b''.join(BSON.encode(doc) for doc in docs)
+    with open(path, 'wb') as f:
+        f.write(gzip.compress(data))
+    return len(docs)
+
+
+# Chunks read but not written yet, at most
+pending = threading.BoundedSemaphore(workers * 2)
+
+
+def submit_chunk(pool, path, docs):
+    pending.acquire()
+    future = pool.submit(write_chunk, path, docs)
+    future.add_done_callback(lambda future: pending.release())
+    return future
+
+
+def export_collection(path, name, pool):
+    # Streams the collection, handing each full chunk to the pool
+    futures = []
+    docs = []
+    for doc in db[name].find().batch_size(1000):
+        docs.append(doc)
+        if len(docs) >= chunk_size:
+            futures.append(submit_chunk(pool, chunk_path(path, name, len(futures)), docs))
+            docs = []
+    if docs:
+        futures.append(submit_chunk(pool, chunk_path(path, name, len(futures)), docs))
+    count = sum(future.result() for future in futures)
+    indexes = []
+    for index, info in db[name].index_information().items():
+        if index != '_id_':
+            options = {k: v for k, v in info.items() if k not in index_fields}
+            options['name'] = index
+            indexes.append({'key': info['key'], 'options': options})
+    l('exported {} documents of {} in {} chunks'.format(count, name, len(futures)))
+    return {'chunks': len(futures), 'count': count, 'indexes': indexes}
+
+
+def export(path):
+    if not os.path.exists(path):
+        os.makedirs(path)
+    status = {doc['_id']: doc['value'] for doc in db.status.find({'_id': {'$in': checkpoints}})}
+    names = sorted(name for name in db.collection_names(include_system_collections=False) if name not in excluded)
+    manifest = {
+        'namespace': ns,
+        'created': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S'),
+        'status': status,
+        'collections': {},
+    }
+    # Readers per collection, writers for the chunks they fill
+    with ThreadPoolExecutor(max_workers=workers) as writers:
+        with ThreadPoolExecutor(max_workers=workers) as readers:
+            results = {name: readers.submit(export_collection, path, name, writers) for name in names}
+            for name, result in results.items():
+                manifest['collections'][name] = result.result()
+    # Written last, a snapshot without a manifest is incomplete
+    with open(os.path.join(path, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    l('exported {} collections at block #{}'.format(len(names), status.get('height_processed')))
+    return manifest
+
+
+def import_chunk(path, name):
+    with open(path, 'rb') as f:
+        docs = decode_all(gzip.decompress(f.read()))
+    for batch in range(0, len(docs), 1000):
+        db[name].insert_many(docs[batch:batch + 1000], ordered=False)
+    return len(docs)
+
+
+def restore(path, drop=False):
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    collections = manifest['collections']
+    existing = [name for name in collections if name in db.collection_names()]
+    if existing and not drop:
+        l('{} already has {}, pass --drop to replace them'.format(ns, ', '.join(sorted(existing))))
+        sys.exit(1)
+    for name in existing:
+        db.drop_collection(name)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for name, info in collections.items():
+            for number in range(info['chunks']):
+                futures[pool.submit(import_chunk, chunk_path(path, name, number), name)] = name
+        counts = {}
+        for future, name in futures.items():
+            counts[name] = counts.get(name, 0) + future.result()
+    # Indexes are built once, over the loaded documents
+    for name, info in sorted(collections.items()):
+        for index in info['indexes']:
+            db[name].create_index([tuple(key) for key in index['key']], **index['options'])
+        l('imported {} documents of {} with {} indexes'.format(counts.get(name, 0), name, len(info['indexes'])))
+    # The exported `status` may be ahead of the rest, resume from the snapshot's
+    for _id, value in manifest['status'].items():
+        db.status.update({'_id': _id}, {'$set': {'value': value}}, upsert=True)
+    # The counters are read at a different time than the content they count
+    for forum in db.forums.find():
+        stats = reconcile(db, forum['_id'], forum)
+        if stats:
+            l('recounted {} to {}'.format(forum['_id'], stats))
+    l('the indexer will resume from block #{}'.format(manifest['status'].get('height_processed')))
+    return counts
+
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    if len(args) != 2 or args[0] not in ['export', 'import']:
+        print('usage: python3 snapshot.py export|import /path/to/snapshot [--drop]')
+        sys.exit(1)
+    if args[0] == 'export':
+        export(args[1])
+    else:
+        restore(args[1], drop='--drop' in sys.argv)
@@ -0,0 +1,41 @@
+from pymongo import MongoClient, UpdateOne
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from content import content_op, split_content
+
+# Moves the bodies (and large json_metadata, see content.py) of the posts and
+# replies stored before they were split out into `content`. Safe to interrupt
+# and run again, only comments that still have a body are processed.
+#
+#   python3 split_content.py [batch_size]
+
+ns = os.environ['namespace'] if 'namespace' in os.environ else 'chainbb'
+mongo = MongoClient('mongodb://mongo')
+db = mongo[ns]
+
+batch_size = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+if __name__ == '__main__':
+    for collection in [db.posts, db.replies]:
+        moved = 0
+        while True:
+            comments = list(collection.find({'body': {'$exists': True}}).limit(batch_size))
+            if not comments:
+                break
+            contents = []
+            ops = []
+            for comment in comments:
+                stored, content = split_content(comment)
+                update = {'$unset': {'body': True}}
+                if 'json_metadata' in content:
+                    update['$set'] = {'json_metadata': stored['json_metadata']}
+                contents.append(content_op(content))
+                ops.append(UpdateOne({'_id': comment['_id']}, update))
+            # Content first, an interrupted batch keeps its bodies until rerun
+            db.content.bulk_write(contents, ordered=False)
+            collection.bulk_write(ops, ordered=False)
+            moved += len(comments)
+            print('[FORUM][CONTENT] - {} {} split'.format(moved, collection.name))
@@ -0,0 +1,30 @@
+# Paid out threads that have been inactive for a while are moved by the
+# indexer from `posts` and `replies` into `posts_archive` and
+# `replies_archive` (see archive.py there), a thread's post and replies
+# together. The loaders look there for what isn't in the active collections.
+
+
+def sort_key(field):
+    # Documents missing the field sort lowest, as in mongo
+    return lambda doc: (field in doc, doc.get(field))
+
+
+def find_merged(collections, query, fields, sort, skip, limit):
+    # A page of the documents matching `query` in either collection, as if
+    # they were one. Each is read up to the end of the page, then merged.
+    results = []
+    for collection in collections:
+        results += list(collection.find(query, fields).sort(sort).limit(skip + limit))
+    # Stable sorts, from the last key to the first
+    for field, direction in reversed(sort):
+        results.sort(key=sort_key(field), reverse=direction == -1)
+    return results[skip:skip + limit]
+
+
+def thread_replies(db, root_post):
+    # The collection holding a thread's replies
+    if db.posts.find_one({'_id': root_post}, {'_id': 1}):
+        return db.replies
+    if db.posts_archive.find_one({'_id': root_post}, {'_id': 1}):
+        return db.replies_archive
+    return db.replies
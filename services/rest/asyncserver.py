@@ -0,0 +1,22 @@
+# Cooperative (gevent) server for the same Flask app and routes.
+#
+# Every socket the app touches - pymongo's connection pool and the steem RPC
+# client - yields to other requests while it waits on IO, so one process can
+# serve many concurrent in-flight requests (a slow get_content fallback or
+# aggregation no longer ties up a whole worker) over a single shared pool of
+# Mongo connections.
+from gevent import monkey
+monkey.patch_all()
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+import os
+
+from main import app
+
+port = int(os.environ['port']) if 'port' in os.environ else 5000
+concurrency = int(os.environ['concurrency']) if 'concurrency' in os.environ else 1000
+
+if __name__ == "__main__":
+    server = WSGIServer(('0.0.0.0', port), app, spawn=Pool(concurrency))
+    server.serve_forever()
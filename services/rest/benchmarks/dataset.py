@@ -0,0 +1,195 @@
+"""
+Synthetic dataset shaped like what the indexer and statistics services write:
+forums, posts and threaded replies with vote arrays (their bodies kept in
+`content`), forum feeds, funding, active user sketches, topics and status
+documents.
+"""
+from datetime import datetime, timedelta
+import importlib.util
+import os
+import random
+import sys
+
+
+def service_module(service, name):
+    # Load a module from a service by path, their names (search, main,
+    # indexes) clash with each other. Modules it imports that don't clash
+    # (ie: hll, jobs) are found after the REST service's own.
+    directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', service)
+    if directory not in sys.path:
+        sys.path.append(directory)
+    path = os.path.join(directory, name + '.py')
+    spec = importlib.util.spec_from_file_location(service.split('/')[0] + '_' + name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def indexer_module(name):
+    return service_module('indexer/steem', name)
+
+
+# The indexer's feed and search modules build the derived collections
+rebuild_forum_feed = indexer_module('feed').rebuild_forum_feed
+SearchIndex = indexer_module('search').SearchIndex
+ActiveUsers = indexer_module('activeusers').ActiveUsers
+split_content = indexer_module('content').split_content
+
+words = (
+    'steem chain forum crypto bitcoin community market price update project release '
+    'vote reward payout witness node block post reply thread question answer help '
+    'guide tutorial story travel photo life music art code python javascript'
+).split()
+
+apps = ['chainbb', 'steemit', 'busy', 'esteem', 'dtube']
+
+
+def sentence(rng, count):
+    return ' '.join(rng.choice(words) for _ in range(count))
+
+
+def comment(rng, now, author, permlink, category, age, parent=None, root=None):
+    created = now - timedelta(minutes=age)
+    doc = {
+        '_id': author + '/' + permlink,
+        'author': author,
+        'permlink': permlink,
+        'category': category,
+        'title': '' if parent else sentence(rng, rng.randint(3, 10)).capitalize(),
+        'body': sentence(rng, rng.randint(20, 800)),
+        'json_metadata': {'app': rng.choice(apps) + '/0.1', 'tags': [category]},
+        'created': created,
+        'active': created,
+        'last_update': created,
+        'cashout_time': created + timedelta(days=7),
+        'last_payout': datetime(1970, 1, 1),
+        'children': 0,
+        'depth': 0,
+        'parent_author': '',
+        'parent_permlink': category,
+        'author_reputation': float(rng.randint(0, 10 ** 13)),
+        'net_votes': 0,
+        'pending_payout_value': round(rng.random() * 50, 3),
+        'total_pending_payout_value': 0.0,
+        'total_payout_value': 0.0,
+        'curator_payout_value': 0.0,
+        'max_accepted_payout': 1000000.0,
+        'percent_steem_dollars': 10000,
+        'active_votes': [['user{}'.format(rng.randint(0, 5000)), rng.choice([10000, 5000, 100])]
+                         for _ in range(int(rng.paretovariate(1.2)) % 400)],
+        'url': '/{}/@{}/{}'.format(category, author, permlink),
+        'root_title': '',
+    }
+    if parent:
+        doc.update({
+            'depth': parent['depth'] + 1,
+            'parent_author': parent['author'],
+            'parent_permlink': parent['permlink'],
+            'parent_id': parent['_id'],
+            'root_post': root['_id'],
+            'root_title': root['title'],
+            'root_namespace': root.get('namespace', False),
+            'url': root['url'] + '#@' + author + '/' + permlink,
+        })
+    return doc
+
+
+def seed(db, forums=40, posts=20000, replies=100000, users=2000, search_db=False, seed=1):
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    for name in ['forums', 'posts', 'replies', 'forum_feed', 'funding', 'activeusers_hll', 'activeusers_recent', 'topics', 'status', 'stats']:
+        db[name].drop()
+
+    tags = ['tag{}'.format(i) for i in range(forums * 4)]
+    forum_docs = []
+    for i in range(forums):
+        forum_docs.append({
+            '_id': 'forum{}'.format(i),
+            'name': 'Forum {}'.format(i),
+            'creator': 'user{}'.format(i),
+            'description': sentence(rng, 10),
+            'group': rng.choice(['projects', 'crypto', 'community']),
+            'group_order': i % 3,
+            'forum_order': i,
+            # A few forums span many tags, the slow case for forum pages
+            'tags': rng.sample(tags, 12 if i % 10 == 0 else rng.randint(1, 4)),
+            'exclusive': False,
+            'funded': round(rng.random() * 100, 3),
+            'stats': {'posts': 0, 'replies': 0},
+        })
+        if i % 5 == 4:
+            forum_docs[-1]['parent'] = 'forum{}'.format(i - 1)
+    db.forums.insert_many(forum_docs)
+
+    # Posts, with categories skewed towards the first tags
+    post_docs = []
+    for i in range(posts):
+        category = tags[min(int(rng.expovariate(1.0 / (len(tags) / 4))), len(tags) - 1)]
+        post_docs.append(comment(rng, now, 'user{}'.format(rng.randint(0, users)), 'post-{}'.format(i), category, rng.randint(0, 60 * 24 * 90)))
+    # Replies are spread over posts with a long tail of megathreads
+    reply_docs = []
+    for i in range(replies):
+        root = post_docs[min(int(rng.paretovariate(0.8)), posts) - 1]
+        thread = [root] + [r for r in reply_docs[-20:] if r['root_post'] == root['_id']]
+        parent = rng.choice(thread)
+        reply = comment(rng, now, 'user{}'.format(rng.randint(0, users)), 're-{}'.format(i), root['category'], rng.randint(0, 60 * 24 * 30), parent=parent, root=root)
+        reply_docs.append(reply)
+        root['children'] += 1
+        root['last_reply'] = reply['created']
+        root['last_reply_by'] = reply['author']
+        root['last_reply_url'] = reply['url']
+    # Stored as the indexer does, with the bodies in `content`
+    for collection, docs in [(db.posts, post_docs), (db.replies, reply_docs)]:
+        for batch in range(0, len(docs), 1000):
+            split = [split_content(doc) for doc in docs[batch:batch + 1000]]
+            collection.insert_many([stored for stored, content in split])
+            db.content.insert_many([content for stored, content in split])
+
+    for forum in forum_docs:
+        rebuild_forum_feed(db, forum['_id'], forum)
+
+    db.funding.insert_many([{
+        '_id': 'tx{}'.format(i),
+        'ns': rng.choice(forum_docs)['_id'],
+        'from': 'user{}'.format(rng.randint(0, users)),
+        'steem_value': round(rng.random() * 20, 3),
+        'timestamp': now - timedelta(hours=i),
+    } for i in range(forums * 20)])
+    active = ActiveUsers(db, 'chainbb')
+    for i in range(users):
+        for app in rng.sample(apps, rng.randint(1, 2)):
+            active.add(app, 'user{}'.format(i), now - timedelta(minutes=rng.randint(0, 60 * 24)))
+    active.flush(now)
+    db.topics.insert_many([{
+        '_id': tag,
+        'updated': now,
+        'last_reply': {'created': now, 'author': 'user1', 'title': 'x', 'url': '/x'},
+    } for tag in tags])
+    db.status.insert_many([
+        {'_id': 'height', 'value': 20000000},
+        {'_id': 'height_processed', 'value': 20000000},
+        {'_id': 'sbd_median_price', 'value': 1.2},
+        {'_id': 'steem_per_mvests', 'value': 490.0},
+    ])
+
+    if search_db:
+        index = SearchIndex(search_db)
+        for post in post_docs:
+            index.index(post, commit=False)
+        index.commit()
+
+    return {
+        'forums': [forum['_id'] for forum in forum_docs],
+        'tags': tags,
+        'posts': [post['_id'] for post in post_docs],
+        'threads': sorted(post_docs, key=lambda post: -post['children'])[:50],
+        'users': ['user{}'.format(i) for i in range(users)],
+    }
+
+
+def create_indexes(db):
+    # Apply the index specs of every service that queries the dataset
+    for spec in [service_module('rest', 'indexes'), indexer_module('indexes'), service_module('statistics/steem', 'indexes')]:
+        for collection, indexes in sorted(spec.indexes.items()):
+            for keys, options in indexes:
+                db[collection].create_index(keys, **options)
@@ -0,0 +1,242 @@
+"""
+Replays a weighted mix of the REST routes (or recorded request paths) against
+the WSGI app and reports latency percentiles and throughput per route.
+
+Seed a local mongod with a synthetic dataset, then run in-process against
+main.app, or over HTTP against a running server with --url:
+
+    python3 benchmarks/load.py --seed --posts 20000 --replies 100000
+    python3 benchmarks/load.py --concurrency 16 --requests 5000
+    python3 benchmarks/load.py --url http://localhost:5000 --paths recorded.txt
+
+--paths replays one request path per line, ie: extracted from access logs.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--mongo', default='mongodb://localhost')
+parser.add_argument('--namespace', default='benchmark')
+parser.add_argument('--search-db', default=os.path.join(tempfile.gettempdir(), 'benchmark-search.db'))
+parser.add_argument('--seed', action='store_true', help='(re)create the synthetic dataset first')
+parser.add_argument('--forums', type=int, default=40)
+parser.add_argument('--posts', type=int, default=20000)
+parser.add_argument('--replies', type=int, default=100000)
+parser.add_argument('--users', type=int, default=2000)
+parser.add_argument('--url', default=False, help='benchmark a running server instead of main.app')
+parser.add_argument('--paths', default=False, help='file of recorded request paths to replay')
+parser.add_argument('--concurrency', type=int, default=8)
+parser.add_argument('--requests', type=int, default=2000)
+parser.add_argument('--warmup', type=int, default=100)
+parser.add_argument('--json', action='store_true', help='print the report as JSON')
+
+# Relative frequency of each route in the generated mix
+weights = [
+    ('/', 10),
+    ('/forum/<slug>', 25),
+    ('/forum/<slug>?page=2', 5),
+    ('/<category>/@<author>/<permlink>', 20),
+    ('/<category>/@<author>/<permlink>/responses', 12),
+    ('/status/<slug>', 2),
+    ('/@<username>', 4),
+    ('/@<username>/replies', 3),
+    ('/@<username>/responses', 2),
+    ('/topics/<category>', 3),
+    ('/active', 4),
+    ('/forums', 3),
+    ('/config', 2),
+    ('/tags', 1),
+    ('/platforms', 1),
+    ('/height', 1),
+    ('/search?q=<word>', 2),
+]
+
+
+def generate(rng, dataset, count):
+    routes = [route for route, weight in weights]
+    cumulative = [weight for route, weight in weights]
+    # Popular threads are requested far more often than the long tail
+    threads = dataset['threads']
+    for _ in range(count):
+        route = rng.choices(routes, cumulative)[0]
+        post = rng.choice(threads) if rng.random() < 0.7 else None
+        if post is None:
+            author, permlink = rng.choice(dataset['posts']).split('/')
+            category = 'tag'
+        else:
+            author, permlink, category = post['author'], post['permlink'], post['category']
+        path = (route
+                .replace('<slug>', rng.choice(dataset['forums']))
+                .replace('<category>', category if '@' in route else rng.choice(dataset['tags']))
+                .replace('<author>', author)
+                .replace('<permlink>', permlink)
+                .replace('<username>', rng.choice(dataset['users']))
+                .replace('<word>', rng.choice(['steem', 'forum', 'python', 'price'])))
+        yield route, path
+
+
+def recorded(filename):
+    with open(filename) as f:
+        for line in f:
+            path = line.strip()
+            if path:
+                yield route_name(path), path
+
+
+def route_name(path):
+    # Group recorded paths by the route they hit
+    from main import app
+    adapter = app.url_map.bind('localhost')
+    try:
+        endpoint, args = adapter.match(path.split('?')[0])
+        return endpoint
+    except Exception:
+        return path
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100.0
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+class Runner(object):
+    def __init__(self, url=False):
+        self.url = url
+        self.local = threading.local()
+        # Import once up front, not concurrently from the worker threads
+        if not url:
+            from main import app
+            self.app = app
+
+    def client(self):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client()
+        return self.local.client
+
+    def request(self, path):
+        started = time.time()
+        if self.url:
+            from urllib.request import urlopen
+            with urlopen(self.url + path) as r:
+                r.read()
+                status = r.status
+        else:
+            r = self.client().get(path)
+            # Drain streamed responses
+            r.get_data()
+            status = r.status_code
+        return status, (time.time() - started) * 1000
+
+
+def run(runner, requests, concurrency):
+    timings = {}
+    errors = {}
+    samples = {}
+    lock = threading.Lock()
+
+    def work(item):
+        route, path = item
+        try:
+            status, elapsed = runner.request(path)
+            error = 'HTTP {}'.format(status) if status >= 500 else False
+        except Exception as e:
+            error, elapsed = repr(e), 0
+        with lock:
+            if not error:
+                timings.setdefault(route, []).append(elapsed)
+            else:
+                errors[route] = errors.get(route, 0) + 1
+                samples.setdefault(route, '{} {}'.format(path, error))
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(work, requests))
+    for route, sample in sorted(samples.items()):
+        print('error: {}'.format(sample))
+    return timings, errors, time.time() - started
+
+
+def report(timings, errors, elapsed):
+    rows = []
+    for route in sorted(set(timings) | set(errors)):
+        values = timings.get(route, [])
+        rows.append({
+            'route': route,
+            'requests': len(values),
+            'errors': errors.get(route, 0),
+            'p50': percentile(values, 50),
+            'p95': percentile(values, 95),
+            'p99': percentile(values, 99),
+            'rps': len(values) / elapsed if elapsed else 0,
+        })
+    everything = [v for values in timings.values() for v in values]
+    total = {
+        'route': 'TOTAL',
+        'requests': len(everything),
+        'errors': sum(errors.values()),
+        'p50': percentile(everything, 50),
+        'p95': percentile(everything, 95),
+        'p99': percentile(everything, 99),
+        'rps': len(everything) / elapsed if elapsed else 0,
+    }
+    return rows + [total]
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    # Point the app at the benchmark database before it's imported
+    os.environ['mongo_uri'] = args.mongo
+    os.environ['namespace'] = args.namespace
+    os.environ['search_db'] = args.search_db
+
+    from pymongo import MongoClient
+    import dataset
+    db = MongoClient(args.mongo)[args.namespace]
+    if args.seed:
+        if os.path.exists(args.search_db):
+            os.remove(args.search_db)
+        print('seeding {} forums, {} posts, {} replies...'.format(args.forums, args.posts, args.replies))
+        info = dataset.seed(db, args.forums, args.posts, args.replies, args.users, search_db=args.search_db)
+        dataset.create_indexes(db)
+        db.benchmark.replace_one({'_id': 'dataset'}, {'_id': 'dataset', 'info': {
+            'forums': info['forums'],
+            'tags': info['tags'],
+            'posts': info['posts'],
+            'threads': [{k: t[k] for k in ('author', 'permlink', 'category')} for t in info['threads']],
+            'users': info['users'],
+        }}, upsert=True)
+    saved = db.benchmark.find_one({'_id': 'dataset'})
+    if not saved and not args.paths:
+        sys.exit('no dataset found, run with --seed first')
+
+    rng = random.Random(2)
+    runner = Runner(args.url)
+    if args.paths:
+        requests = list(recorded(args.paths))
+    else:
+        requests = list(generate(rng, saved['info'], args.requests + args.warmup))
+    # Warm caches and connection pools before measuring
+    run(runner, requests[:args.warmup], args.concurrency)
+    timings, errors, elapsed = run(runner, requests[args.warmup:], args.concurrency)
+    rows = report(timings, errors, elapsed)
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+    else:
+        print('{:<45} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9}'.format('route', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'))
+        for row in rows:
+            print('{route:<45} {requests:>8} {errors:>6} {p50:>9.1f} {p95:>9.1f} {p99:>9.1f} {rps:>9.1f}'.format(**row))
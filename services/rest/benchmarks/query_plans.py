@@ -0,0 +1,220 @@
+"""
+Query plan regression check: requests every REST route and runs the
+statistics jobs against a seeded mongod, then explains each query they issued
+and fails when one scans a whole collection or sorts in memory.
+
+    python3 benchmarks/query_plans.py --seed
+    python3 benchmarks/query_plans.py --verbose
+
+Exits with a non-zero status when a query has a bad plan, so it can run in CI
+after a change to a route, a query or one of the indexes.py specs.
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import tempfile
+
+from pymongo import monitoring
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--mongo', default='mongodb://localhost')
+parser.add_argument('--namespace', default='benchmark')
+parser.add_argument('--search-db', default=os.path.join(tempfile.gettempdir(), 'benchmark-search.db'))
+parser.add_argument('--seed', action='store_true', help='(re)create the synthetic dataset first')
+parser.add_argument('--forums', type=int, default=40)
+parser.add_argument('--posts', type=int, default=5000)
+parser.add_argument('--replies', type=int, default=20000)
+parser.add_argument('--users', type=int, default=1000)
+parser.add_argument('--verbose', action='store_true', help='print the plan of every query')
+
+# Commands whose plans are checked
+explained = ['find', 'count', 'aggregate', 'distinct']
+
+# Collections that are small (or capped) by design, scanning them is expected
+small = ['benchmark', 'forums', 'status', 'stats']
+
+# Queries that read a whole collection on purpose, by where they're issued
+expected_scans = {
+    # Totals the funding of every forum, once an hour
+    'update_all_forums': ['funding'],
+}
+
+# Stages that mean the plan isn't using an index the way it should
+bad_stages = ['COLLSCAN', 'SORT']
+
+
+class Recorder(monitoring.CommandListener):
+    def __init__(self):
+        self.source = 'setup'
+        self.commands = []
+
+    def started(self, event):
+        if event.command_name in explained:
+            self.commands.append((self.source, event.database_name, copy.deepcopy(event.command)))
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def paths(info):
+    thread = info['threads'][0]
+    post = '/{}/@{}/{}'.format(thread['category'], thread['author'], thread['permlink'])
+    user = thread['author']
+    forum = info['forums'][0]
+    return [
+        '/',
+        '/forums',
+        '/config',
+        '/tags',
+        '/active',
+        '/height',
+        '/platforms',
+        '/forum/{}'.format(forum),
+        '/forum/{}?page=3'.format(forum),
+        '/forum/{}?filter={}'.format(forum, info['tags'][0]),
+        '/forum/{}?filter=all'.format(forum),
+        '/status/{}'.format(forum),
+        '/stats/{}'.format(forum),
+        '/stats/{}?resolution=minute'.format(forum),
+        '/topics/{}'.format(info['tags'][0]),
+        post,
+        post + '/responses',
+        post + '/responses?limit=50',
+        post + '/tree',
+        '/@{}'.format(user),
+        '/@{}/replies'.format(user),
+        '/@{}/responses'.format(user),
+        '/api/ns_lookup?ns=missing',
+        '/search?q=steem',
+        '/batch?posts={}&accounts={}'.format(','.join(info['posts'][:20]), ','.join(info['users'][:20])),
+    ]
+
+
+def stages(plan):
+    # Every stage of a query plan tree
+    yield plan
+    for key in ['inputStage', 'outerStage', 'innerStage']:
+        if key in plan:
+            yield from stages(plan[key])
+    for child in plan.get('inputStages', []):
+        yield from stages(child)
+
+
+def explain(db, command):
+    name = next(iter(command))
+    command = {k: v for k, v in command.items() if not k.startswith('$') and k != 'lsid'}
+    if name == 'aggregate':
+        # Explaining an aggregate through the explain command needs 3.4+
+        command.pop('cursor', None)
+        command['explain'] = True
+        result = db.command(command)
+        pipeline = result.get('stages', [])
+        cursor = pipeline[0].get('$cursor', {}) if pipeline else {}
+        plan = cursor.get('queryPlanner', {}).get('winningPlan', {})
+        return plan, [next(iter(stage)) for stage in pipeline[1:]]
+    result = db.command('explain', command, verbosity='queryPlanner')
+    return result['queryPlanner']['winningPlan'], []
+
+
+def check(db, source, command):
+    name = next(iter(command))
+    collection = command[name]
+    plan, pipeline = explain(db, command)
+    problems = []
+    if collection not in small and collection not in expected_scans.get(source, []):
+        for stage in stages(plan):
+            if stage.get('stage') in bad_stages:
+                problems.append(stage['stage'])
+        # A $sort left in the pipeline before a $group sorts every document in memory
+        if '$sort' in pipeline and ('$group' not in pipeline or pipeline.index('$sort') < pipeline.index('$group')):
+            problems.append('$sort')
+    return collection, plan, problems
+
+
+def run_routes(app, recorder, info):
+    client = app.test_client()
+    for path in paths(info):
+        recorder.source = path
+        r = client.get(path)
+        r.get_data()
+        if r.status_code >= 500:
+            print('error: {} returned {}'.format(path, r.status_code))
+
+
+def run_statistics(recorder, mongo, namespace):
+    import dataset
+    statistics = dataset.service_module('statistics/steem', 'main')
+    # The service connects to mongodb://mongo, point it at the benchmark
+    statistics.db = mongo[namespace]
+    jobs = [
+        ('update_forum', lambda: [statistics.update_forum(forum) for forum in statistics.db.forums.find().limit(5)]),
+        ('update_all_forums', statistics.update_all_forums),
+        ('update_active_users', statistics.update_active_users),
+        ('update_homepage', statistics.update_homepage),
+    ]
+    for source, job in jobs:
+        recorder.source = source
+        job()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    os.environ['mongo_uri'] = args.mongo
+    os.environ['namespace'] = args.namespace
+    os.environ['search_db'] = args.search_db
+
+    # Listeners registered before a client is created apply to it
+    recorder = Recorder()
+    monitoring.register(recorder)
+
+    from pymongo import MongoClient
+    import dataset
+    mongo = MongoClient(args.mongo)
+    db = mongo[args.namespace]
+    if args.seed:
+        if os.path.exists(args.search_db):
+            os.remove(args.search_db)
+        print('seeding {} forums, {} posts, {} replies...'.format(args.forums, args.posts, args.replies))
+        info = dataset.seed(db, args.forums, args.posts, args.replies, args.users, search_db=args.search_db)
+        db.benchmark.replace_one({'_id': 'dataset'}, {'_id': 'dataset', 'info': {
+            'forums': info['forums'],
+            'tags': info['tags'],
+            'posts': info['posts'],
+            'threads': [{k: t[k] for k in ('author', 'permlink', 'category')} for t in info['threads']],
+            'users': info['users'],
+        }}, upsert=True)
+    saved = db.benchmark.find_one({'_id': 'dataset'})
+    if not saved:
+        sys.exit('no dataset found, run with --seed first')
+    dataset.create_indexes(db)
+
+    from main import app
+    run_routes(app, recorder, saved['info'])
+    run_statistics(recorder, mongo, args.namespace)
+
+    seen = set()
+    failures = 0
+    for source, database, command in recorder.commands:
+        if database != args.namespace:
+            continue
+        # Check each distinct query shape once per source
+        key = (source, json.dumps(command, sort_keys=True, default=str))
+        if key in seen:
+            continue
+        seen.add(key)
+        collection, plan, problems = check(db, source, command)
+        if problems:
+            failures += 1
+            print('FAIL {} {}.{}: {}'.format(source, collection, next(iter(command)), ', '.join(sorted(set(problems)))))
+            print('     {}'.format(json.dumps(command, sort_keys=True, default=str)))
+        elif args.verbose:
+            print('ok   {} {}.{}: {}'.format(source, collection, next(iter(command)), ' <- '.join(stage.get('stage', '?') for stage in stages(plan))))
+    print('{} queries checked, {} with bad plans'.format(len(seen), failures))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,129 @@
+"""
+Compare the current Flask/MongoJsonEncoder serialization against the fast
+`dumps` path and the streaming `stream_envelope` path.
+
+Payloads are loaded from a live database (the same queries as /config, /tags,
+a forum page and the largest thread), or generated with --synthetic.
+
+    python3 benchmarks/serialization.py --mongo mongodb://localhost --namespace chainbb
+    python3 benchmarks/serialization.py --synthetic
+"""
+from datetime import datetime, timedelta
+import argparse
+import json as stdjson
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from bson.objectid import ObjectId
+from mongodb_jsonencoder import MongoJsonEncoder, dumps, json, orjson, stream_envelope
+
+
+def load_payloads(db):
+    payloads = {}
+    payloads['config'] = list(db.forums.find())
+    payloads['tags'] = list(db.topics.find().sort([('last_reply', -1)]))
+    payloads['forum'] = list(db.posts.find({}).sort([('active', -1)]).limit(20))
+    largest = list(db.replies.aggregate([
+        {'$group': {'_id': '$root_post', 'count': {'$sum': 1}}},
+        {'$sort': {'count': -1}},
+        {'$limit': 1}
+    ]))
+    if largest:
+        payloads['thread'] = list(db.replies.find({'root_post': largest[0]['_id']}).sort([('created', 1)]))
+    return {k: v for k, v in payloads.items() if v}
+
+
+def synthetic_post(idx, now, reply=False):
+    author = 'user{}'.format(idx % 500)
+    permlink = 'post-{}'.format(idx)
+    post = {
+        '_id': author + '/' + permlink,
+        'author': author,
+        'permlink': permlink,
+        'category': 'tag{}'.format(idx % 50),
+        'title': '' if reply else 'A synthetic post title #{}'.format(idx),
+        'body': 'Lorem ipsum dolor sit amet. ' * random.randint(5, 200),
+        'json_metadata': {'app': 'chainbb/0.3', 'tags': ['tag1', 'tag2']},
+        'created': now - timedelta(minutes=idx),
+        'active': now - timedelta(minutes=idx),
+        'last_update': now - timedelta(minutes=idx),
+        'cashout_time': now + timedelta(days=7),
+        'last_payout': datetime(1970, 1, 1),
+        'children': random.randint(0, 50),
+        'depth': 1 if reply else 0,
+        'pending_payout_value': random.random() * 100,
+        'total_payout_value': 0.0,
+        'author_reputation': float(random.randint(0, 10 ** 12)),
+        'active_votes': [['voter{}'.format(v), 10000] for v in range(random.randint(0, 300))],
+        'url': '/tag/@{}/{}'.format(author, permlink),
+    }
+    return post
+
+
+def synthetic_payloads():
+    now = datetime.utcnow()
+    forums = [{
+        '_id': 'forum{}'.format(i),
+        'name': 'Forum {}'.format(i),
+        'tags': ['tag{}'.format(t) for t in range(i, i + 5)],
+        'last_post': {'created': now, 'author': 'user1', 'title': 'x', 'url': '/x'},
+        'stats': {'posts': 1000, 'replies': 10000},
+    } for i in range(200)]
+    topics = [{'_id': 'tag{}'.format(i), 'updated': now, '_oid': ObjectId()} for i in range(2000)]
+    return {
+        'config': forums,
+        'tags': topics,
+        'forum': [synthetic_post(i, now) for i in range(20)],
+        'thread': [synthetic_post(i, now, reply=True) for i in range(3000)],
+    }
+
+
+def envelope(data):
+    return {'status': 'ok', 'network': {'height': 1, 'sbd_median_price': 1.0}, 'data': data}
+
+
+def current(data):
+    # Mirrors flask.jsonify with app.json_encoder = MongoJsonEncoder
+    return json.dumps(envelope(data), cls=MongoJsonEncoder, sort_keys=True)
+
+
+def fast(data):
+    return dumps(envelope(data))
+
+
+def streaming(data):
+    placeholder = object()
+    return b''.join(stream_envelope(envelope(placeholder), placeholder, iter(data)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mongo', default='mongodb://localhost')
+    parser.add_argument('--namespace', default='chainbb')
+    parser.add_argument('--synthetic', action='store_true')
+    parser.add_argument('--number', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        payloads = synthetic_payloads()
+    else:
+        from pymongo import MongoClient
+        payloads = load_payloads(MongoClient(args.mongo)[args.namespace])
+
+    print('fast path: {}'.format('orjson' if orjson else 'MongoJsonEncoder (orjson not installed)'))
+    print('{:<10} {:>6} {:>10} {:>12} {:>12} {:>12}'.format('payload', 'docs', 'bytes', 'current ms', 'fast ms', 'stream ms'))
+    for name, data in sorted(payloads.items()):
+        # All three must produce the same document
+        expected = stdjson.loads(current(data))
+        assert stdjson.loads(fast(data).decode('utf-8')) == expected
+        assert stdjson.loads(streaming(data).decode('utf-8')) == expected
+        timings = [
+            timeit.timeit(lambda: fn(data), number=args.number) * 1000 / args.number
+            for fn in (current, fast, streaming)
+        ]
+        print('{:<10} {:>6} {:>10} {:>12.2f} {:>12.2f} {:>12.2f}'.format(
+            name, len(data), len(fast(data)), *timings))
@@ -0,0 +1,66 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class Flight(object):
+    # A load in progress that other requests for the same key wait on
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ReadThroughCache(object):
+    """ Bounded LRU cache with a TTL per entry, filled by calling `loader`.
+
+        Concurrent misses for the same key share a single call to the loader
+        (single-flight), and results `is_negative` considers "not found" are
+        kept for the shorter `negative_ttl`. Errors are never cached.
+    """
+
+    def __init__(self, loader, maxsize=1000, ttl=60, negative_ttl=10, is_negative=None):
+        self.loader = loader
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.is_negative = is_negative or (lambda value: value is None)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.flights = {}
+
+    def get(self, *key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] > time.time():
+                self.entries.move_to_end(key)
+                return entry[1]
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        # Someone else is already loading this key, wait for their result
+        if not leader:
+            flight.event.wait()
+            if flight.error:
+                raise flight.error
+            return flight.value
+        try:
+            flight.value = self.loader(*key)
+            self.set(key, flight.value)
+            return flight.value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self.flights.pop(key, None)
+            flight.event.set()
+
+    def set(self, key, value):
+        ttl = self.negative_ttl if self.is_negative(value) else self.ttl
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
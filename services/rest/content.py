@@ -0,0 +1,42 @@
+import json
+import zlib
+
+# Post and reply bodies are stored apart from `posts` and `replies`, zlib
+# compressed in `content` (see content.py in the indexer), along with the
+# json_metadata of comments where it's large. They're joined back here for the
+# routes that show them, in one query per page of comments.
+
+
+def decompress(value):
+    return zlib.decompress(value).decode('utf-8')
+
+
+def join_content(db, comments):
+    # Comments stored before the split still have their body
+    pending = {}
+    for comment in comments:
+        if comment and 'body' not in comment:
+            pending.setdefault(comment['_id'], []).append(comment)
+    if pending:
+        for content in db.content.find({'_id': {'$in': list(pending)}}):
+            for comment in pending[content['_id']]:
+                comment['body'] = decompress(content['body'])
+                if 'json_metadata' in content:
+                    comment['json_metadata'] = json.loads(decompress(content['json_metadata']))
+        for matches in pending.values():
+            for comment in matches:
+                comment.setdefault('body', '')
+    return comments
+
+
+def stream_content(db, comments, batch_size=100):
+    # join_content over a cursor, a batch at a time
+    batch = []
+    for comment in comments:
+        batch.append(comment)
+        if len(batch) >= batch_size:
+            for joined in join_content(db, batch):
+                yield joined
+            batch = []
+    for joined in join_content(db, batch):
+        yield joined
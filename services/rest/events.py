@@ -0,0 +1,120 @@
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from pymongo import CursorType
+import queue
+import threading
+import time
+
+# Fans the indexer's `events` log out to the clients subscribed to /events.
+# One tailable cursor per process follows the capped collection, and every
+# event is put on the queue of each subscription listening on one of its
+# channels, so the cost of a new post no longer grows with the number of
+# clients waiting for it.
+
+
+class Subscription(object):
+    def __init__(self, channels, maxsize):
+        self.channels = channels
+        self.queue = queue.Queue(maxsize)
+        # Set when the client fell too far behind, it should reconnect and
+        # resume from its last event id
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBroker(object):
+    def __init__(self, db, queue_size=1000, max_subscriptions=1000):
+        self.db = db
+        self.queue_size = queue_size
+        self.max_subscriptions = max_subscriptions
+        self.lock = threading.Lock()
+        self.channels = {}
+        self.count = 0
+        self.thread = None
+
+    def subscribe(self, channels):
+        # Returns False when this process already serves as many as it may
+        with self.lock:
+            if self.count >= self.max_subscriptions:
+                return False
+            # The tailing thread starts with the first subscriber, after
+            # uwsgi has forked the worker
+            if not self.thread:
+                self.thread = threading.Thread(target=self.tail, name='events')
+                self.thread.daemon = True
+                self.thread.start()
+            subscription = Subscription(channels, self.queue_size)
+            for channel in channels:
+                self.channels.setdefault(channel, set()).add(subscription)
+            self.count += 1
+            return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for channel in subscription.channels:
+                subscribers = self.channels.get(channel)
+                if subscribers:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.channels[channel]
+            self.count -= 1
+
+    def publish(self, event):
+        with self.lock:
+            subscriptions = set()
+            for channel in event['channels']:
+                subscriptions.update(self.channels.get(channel, ()))
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def replay(self, channels, after, limit=500):
+        # Events a reconnecting client missed since `after`, while still in the
+        # log, up to the log's current tail (the stream carries on from there).
+        # Read through the {channels, _id} index, and if it missed more than
+        # `limit` only the latest are replayed.
+        try:
+            after = ObjectId(after)
+        except (InvalidId, TypeError):
+            return []
+        tail = self.latest()
+        if tail is None or tail <= after:
+            return []
+        events = list(self.db.events.find({
+            'channels': {'$in': channels},
+            '_id': {'$gt': after, '$lte': tail},
+        }).sort('_id', -1).limit(limit))
+        events.reverse()
+        return events
+
+    def latest(self):
+        for event in self.db.events.find({}, {'_id': 1}).sort('$natural', -1).limit(1):
+            return event['_id']
+        return None
+
+    def tail(self):
+        last = None
+        while True:
+            try:
+                if last is None:
+                    last = self.latest()
+                query = {'_id': {'$gt': last}} if last else {}
+                cursor = self.db.events.find(query, cursor_type=CursorType.TAILABLE_AWAIT)
+                while cursor.alive:
+                    for event in cursor:
+                        last = event['_id']
+                        self.publish(event)
+            except Exception as e:
+                print('[FORUM][REST][events] tailing failed: {}'.format(e))
+            # The cursor dies on an empty log, or if the log wrapped around it
+            time.sleep(1)
@@ -0,0 +1,62 @@
+from pymongo import MongoClient
+
+# Indexes the REST routes query through, applied when the service starts.
+# create_index is a no-op for indexes that already exist, and other services
+# declare the indexes their own queries need in their indexes.py.
+
+indexes = {
+    'forum_feed': [
+        ([('forum', 1), ('active', -1)], {}),
+        ([('forum', 1), ('category', 1), ('active', -1)], {}),
+    ],
+    # Replayed to reconnecting /events clients by channel
+    'events': [
+        ([('channels', 1), ('_id', 1)], {}),
+    ],
+    'funding': [
+        ([('ns', 1), ('timestamp', -1)], {}),
+    ],
+    'posts': [
+        ([('active', 1)], {}),
+        ([('author', 1), ('permlink', 1)], {}),
+        ([('author', 1), ('created', -1)], {}),
+        ([('category', 1), ('active', 1), ('cbb', 1)], {}),
+        ([('category', 1), ('last_reply', 1), ('created', 1)], {}),
+        ([('last_reply', 1), ('created', 1)], {}),
+    ],
+    # Archived threads are only loaded directly, by thread or by account
+    'posts_archive': [
+        ([('author', 1), ('created', -1)], {}),
+    ],
+    'replies': [
+        ([('author', 1), ('created', -1)], {}),
+        ([('parent_author', 1), ('created', 1)], {}),
+        ([('parent_id', 1), ('created', 1), ('_id', 1)], {}),
+        ([('root_post', 1), ('created', 1), ('_id', 1)], {}),
+    ],
+    'replies_archive': [
+        ([('author', 1), ('created', -1)], {}),
+        ([('parent_author', 1), ('created', 1)], {}),
+        ([('parent_id', 1), ('created', 1), ('_id', 1)], {}),
+        ([('root_post', 1), ('created', 1), ('_id', 1)], {}),
+    ],
+    'timeseries': [
+        ([('forum', 1), ('resolution', 1), ('start', 1)], {}),
+    ],
+    'topics': [
+        ([('last_reply', 1)], {}),
+    ],
+}
+
+
+def ensure_indexes(uri, ns):
+    # Uses its own short-lived client so no sockets are shared with the
+    # processes uwsgi forks after the app is imported
+    client = MongoClient(uri)
+    try:
+        db = client[ns]
+        for collection, specs in sorted(indexes.items()):
+            for keys, options in specs:
+                db[collection].create_index(keys, **options)
+    finally:
+        client.close()
@@ -1,27 +1,76 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, request, stream_with_context
 from pprint import pprint
 from pymongo import MongoClient
-from bson.json_util import dumps
 from flask_cors import CORS, cross_origin
-from mongodb_jsonencoder import MongoJsonEncoder
+from archive import find_merged, thread_replies
+from datetime import datetime
+from cache import ReadThroughCache
+from content import join_content, stream_content
+from events import EventBroker
+from indexes import ensure_indexes
+from metrics import CommandTimer, RequestMetrics, current, metrics, serialized_stream, serializing
+from mongodb_jsonencoder import MongoJsonEncoder, dumps, stream_envelope
+from registry import ForumRegistry
+from search import search as fulltext_search
 from steem import Steem
+import timeseries
 import os
+import sqlite3
 
 ns = os.environ['namespace'] if 'namespace' in os.environ else 'chainbb'
-mongo = MongoClient("mongodb://mongo", connect=False)
+# One pool per process, shared by every request (and every greenlet when
+# served by asyncserver.py)
+pool_size = int(os.environ['mongo_pool_size']) if 'mongo_pool_size' in os.environ else 100
+mongo_uri = os.environ['mongo_uri'] if 'mongo_uri' in os.environ else 'mongodb://mongo'
+mongo = MongoClient(mongo_uri, connect=False, maxPoolSize=pool_size, event_listeners=[CommandTimer()])
 db = mongo[ns]
 
+# Create any missing indexes the routes query through, before uwsgi forks
+if 'ensure_indexes' not in os.environ or os.environ['ensure_indexes'] != 'false':
+    ensure_indexes(mongo_uri, ns)
+
+# In-memory copy of the forums, reloaded when its version changes
+forums_registry = ForumRegistry(db)
+
+# Full-text search index, maintained by the indexer
+search_db = os.environ['search_db'] if 'search_db' in os.environ else '/data/search.db'
+
 nodes = [
     os.environ['steem_node'] if 'steem_node' in os.environ else 'https://api.steemit.com',
 ]
 s = Steem(nodes)
 
+# Content for posts that aren't indexed is fetched from the node through a
+# shared cache, so repeated (and concurrent) requests cost a single RPC.
+# Missing posts come back with an empty author and are cached briefly.
+content_cache = ReadThroughCache(
+    lambda author, permlink: s.get_content(author, permlink),
+    maxsize=int(os.environ['content_cache_size']) if 'content_cache_size' in os.environ else 5000,
+    ttl=int(os.environ['content_cache_ttl']) if 'content_cache_ttl' in os.environ else 60,
+    negative_ttl=10,
+    is_negative=lambda content: not content or content['author'] == '',
+)
+
 app = Flask(__name__)
 app.json_encoder = MongoJsonEncoder
 CORS(app)
 
+# Per route latency, mongo and serialization time for /metrics. Set
+# profile_sample_rate (0-1) to profile that share of requests, logging the
+# profiles of those slower than profile_slow_ms.
+app.wsgi_app = RequestMetrics(
+    app.wsgi_app,
+    sample_rate=float(os.environ['profile_sample_rate']) if 'profile_sample_rate' in os.environ else 0.0,
+    slow=float(os.environ['profile_slow_ms']) / 1000 if 'profile_slow_ms' in os.environ else 1.0,
+)
 
-def response(json, forum=False, children=False, meta=False, status='ok'):
+
+@app.before_request
+def metrics_route():
+    current.route = request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def envelope(json, forum=False, children=False, meta=False, status='ok'):
     # Load height
     # NYI - should be cached at for 3 seconds
     statuses = db.status.find()
@@ -39,7 +88,7 @@ def response(json, forum=False, children=False, meta=False, status='ok'):
         response.update({
             'forum': forum
         })
-    if children:
+    if children is not False:
         response.update({
             'children': list(children)
         })
@@ -47,7 +96,21 @@ def response(json, forum=False, children=False, meta=False, status='ok'):
         response.update({
             'meta': meta
         })
-    return jsonify(response)
+    return response
+
+
+def response(json, forum=False, children=False, meta=False, status='ok'):
+    body = envelope(json, forum, children, meta, status)
+    return Response(serializing(dumps, body), mimetype='application/json')
+
+
+def stream_response(results, forum=False, children=False, meta=False, status='ok', key=False):
+    # Encode each document as the cursor is read instead of building the
+    # list in memory. `key` nests the list within data, ie: {'forums': [...]}
+    placeholder = object()
+    json = {key: placeholder} if key else placeholder
+    body = stream_envelope(envelope(json, forum, children, meta, status), placeholder, results)
+    return Response(stream_with_context(serialized_stream(body)), mimetype='application/json')
 
 
 def load_post(author, permlink):
@@ -57,43 +120,112 @@ def load_post(author, permlink):
         'permlink': permlink
     }
     post = db.posts.find_one(query)
+    if not post:
+        post = db.posts_archive.find_one({'_id': author + '/' + permlink})
     if post and 'active_votes' in post:
-        # A dict to store vote information
-        votes = {}
-        # Loop over current votes and add them to the new simple dict
-        for vote in post['active_votes']:
-            votes.update({vote[0]: vote[1]})
-        # Remove old active_votes
-        post.pop('active_votes', None)
-        # Add the new simple votes
-        post.update({
-            'votes': votes
-        })
+        format_votes(post)
+    if post:
+        join_content(db, [post])
     return post
 
 
-def load_replies(query, sort):
-    replies = []
-    results = db.replies.find(query).sort(sort)
-    for idx, post in enumerate(results):
+def format_votes(post):
+    # A dict to store vote information
+    votes = {}
+    # Loop over current votes and add them to the new simple dict
+    for vote in post['active_votes']:
+        votes.update({vote[0]: vote[1]})
+    # Remove old active_votes
+    post.pop('active_votes', None)
+    # Add the new simple votes
+    post.update({
+        'votes': votes
+    })
+    return post
+
+
+def load_replies(query, sort, limit=0, collection=None):
+    # From `replies` unless given the archive's, see thread_replies
+    collection = collection or db.replies
+    results = collection.find(query).sort(sort).limit(limit)
+    for post in stream_content(db, results):
         if post and 'active_votes' in post:
-            # A dict to store vote information
-            votes = {}
-            # Loop over current votes and add them to the new simple dict
-            for vote in post['active_votes']:
-                votes.update({vote[0]: vote[1]})
-            # Remove old active_votes
-            post.pop('active_votes', None)
-            # Add the new simple votes
-            post.update({
-                'votes': votes
-            })
-            replies.append(post)
-    return replies
+            yield format_votes(post)
+
+
+# Paged replies are ordered by (created, _id) so cursors stay stable as new
+# replies arrive, and are served by the {parent_id, created, _id} and
+# {root_post, created, _id} indexes
+reply_sort = [('created', 1), ('_id', 1)]
+
+
+def encode_cursor(reply):
+    return '{}|{}'.format(reply['created'].strftime('%Y-%m-%dT%H:%M:%S'), reply['_id'])
+
+
+def cursor_query(cursor):
+    # Match only the replies after the one the cursor was generated from
+    created, _id = cursor.split('|', 1)
+    created = datetime.strptime(created, '%Y-%m-%dT%H:%M:%S')
+    return {'$or': [
+        {'created': {'$gt': created}},
+        {'created': created, '_id': {'$gt': _id}},
+    ]}
+
+
+def load_reply_page(query, limit, after=False, collection=None):
+    if after:
+        query = {'$and': [query, cursor_query(after)]}
+    # Load one extra reply to know if there is another page
+    replies = list(load_replies(query, reply_sort, limit + 1, collection))
+    cursor = encode_cursor(replies[limit - 1]) if len(replies) > limit else False
+    return replies[:limit], cursor
+
+
+# Most replies a single /tree request loads, whatever its depth and limits
+tree_max_replies = int(os.environ['tree_max_replies']) if 'tree_max_replies' in os.environ else 500
+
+
+def load_reply_tree(parent_id, depth, limit, branch_limit, after=False, collection=None, budget=None):
+    # `budget` is shared by every branch, once it runs out the remaining
+    # branches are returned as cursors, so a request makes at most one query
+    # per loaded reply however wide the tree is
+    if budget is None:
+        budget = {'replies': tree_max_replies}
+    replies, cursor = load_reply_page({'parent_id': parent_id}, min(limit, budget['replies']), after, collection)
+    budget['replies'] -= len(replies)
+    for reply in replies:
+        reply['replies'] = []
+        reply['more'] = False
+        if reply.get('children', 0) > 0:
+            if depth > 1 and budget['replies'] > 0:
+                reply['replies'], reply['more'] = load_reply_tree(reply['_id'], depth - 1, branch_limit, branch_limit, collection=collection, budget=budget)
+            else:
+                # Out of depth (or budget), return a cursor to load this branch separately
+                reply['more'] = {'parent': reply['_id'], 'after': False}
+    more = {'parent': parent_id, 'after': cursor} if cursor else False
+    return replies, more
+
+
+def int_arg(name, default, low, high):
+    # A query argument clamped to [low, high], ValueError if it isn't a number
+    return max(low, min(int(request.args.get(name, default)), high))
+
+
+def bad_request(message):
+    return response({}, meta={'error': message}, status='error'), 400
 
 
 @app.route("/")
 def index():
+    # Materialized by the statistics service (update_homepage)
+    snapshot = db.stats.find_one({'_id': 'homepage'})
+    if snapshot:
+        return response({
+            'forums': snapshot['forums'],
+            'users': snapshot['users']
+        })
+    # No snapshot yet, build it on the fly
     query = {
         "group": {"$in": [
             "localtesting",  # localtesting never exists on live, only in dev
@@ -104,27 +236,25 @@ def index():
     }
     sort = [("group_order", 1), ("forum_order", 1)]
     results = db.forums.find(query).sort(sort)
-    appusers = db.activeusers.find({'app': ns}, {'_id': 1})
+    active = db.stats.find_one({'_id': 'users-24h'}) or {}
+    recent = db.activeusers_recent.find_one({'_id': ns}) or {'users': []}
     return response({
         'forums': list(results),
         'users': {
             'stats': {
-                'total': db.activeusers.count(),
-                'app': db.activeusers.count({'app': ns}),
+                'total': active.get('total', 0),
+                'app': active.get('platforms', {}).get(ns.replace('.', '-'), 0),
             },
-            'list': list(appusers)
+            'list': [{'_id': user['_id']} for user in recent['users'][:100]]
         }
     })
 
 
 @app.route("/forums")
 def forums():
-    query = {}
-    sort = [("highlight", -1), ("_id", 1), ("parent", 1)]
-    results = db.forums.find(query).sort(sort)
-    return response({
-        'forums': list(results)
-    })
+    # Sorted by highlight, _id, parent
+    results = forums_registry.all(ordered=True)
+    return stream_response(iter(results), key='forums')
 
 
 @app.route("/@<username>")
@@ -149,10 +279,10 @@ def account(username):
     perPage = 20
     skip = (page - 1) * perPage
     limit = perPage
-    total = db.posts.count(query)
-    posts = db.posts.find(query, fields).sort(sort).skip(skip).limit(limit)
+    total = db.posts.count(query) + db.posts_archive.count(query)
+    posts = find_merged([db.posts, db.posts_archive], query, fields, sort, skip, limit)
     return response({
-        'posts': list(posts),
+        'posts': posts,
         'total': total,
         'page': page
     })
@@ -165,81 +295,86 @@ def replies(username):
     perPage = 10
     skip = (page - 1) * perPage
     limit = perPage
-    pipeline = [
-        {'$match': {
-            'parent_author': username,
-            'author': {'$ne': username},
-        }},
-        {'$sort': sort},
-        {'$project': {
-            'parent_id': {'$concat': ['$parent_author', '/', '$parent_permlink']},
-            'reply': '$$ROOT'
-        }},
-        {'$lookup': {
-            'from': 'posts',
-            'localField': 'parent_id',
-            'foreignField': '_id',
-            'as': 'parent_post'
-        }},
-        {'$lookup': {
-            'from': 'replies',
-            'localField': 'parent_id',
-            'foreignField': '_id',
-            'as': 'parent_reply'
-        }},
-        {'$project': {
-            'reply': 1,
-            'parent': {
-                '$cond': {
-                    'if': {'$eq': ["$parent_reply", []]},
-                    'then': '$parent_post',
-                    'else': '$parent_reply'
+    def pipeline(posts, replies):
+        # Replies joined to their parents from the same tier
+        return [
+            {'$match': {
+                'parent_author': username,
+                'author': {'$ne': username},
+            }},
+            {'$sort': sort},
+            {'$project': {
+                'parent_id': {'$concat': ['$parent_author', '/', '$parent_permlink']},
+                'reply': '$$ROOT'
+            }},
+            {'$lookup': {
+                'from': posts,
+                'localField': 'parent_id',
+                'foreignField': '_id',
+                'as': 'parent_post'
+            }},
+            {'$lookup': {
+                'from': replies,
+                'localField': 'parent_id',
+                'foreignField': '_id',
+                'as': 'parent_reply'
+            }},
+            {'$project': {
+                'reply': 1,
+                'parent': {
+                    '$cond': {
+                        'if': {'$eq': ["$parent_reply", []]},
+                        'then': '$parent_post',
+                        'else': '$parent_reply'
+                    }
                 }
-            }
-        }},
-        {'$unwind': '$parent'},
-        {'$project': {
-            'reply': {
-                '_id': 1,
-                'active_votes': 1,
-                'author': 1,
-                'body': 1,
-                'category': 1,
-                'created': 1,
-                'depth': 1,
-                'json_metadata': 1,
-                'parent_author': 1,
-                'parent_permlink': 1,
-                'permlink': 1,
-                'root_namespace': 1,
-                'root_post': 1,
-                'root_title': 1,
-                'title': 1,
-                'url': 1,
-            },
-            'parent': {
-                '_id': 1,
-                'active_votes': 1,
-                'author': 1,
-                'body': 1,
-                'category': 1,
-                'created': 1,
-                'depth': 1,
-                'parent_author': 1,
-                'parent_permlink': 1,
-                'permlink': 1,
-                'namespace': 1,
-                'root_namespace': 1,
-                'root_title': 1,
-                'title': 1,
-                'url': 1,
-            }
-        }},
-        {'$limit': limit + skip},
-        {'$skip': skip},
-    ]
-    total = db.replies.count({'parent_author': username})
-    replies = db.replies.aggregate(pipeline)
+            }},
+            {'$unwind': '$parent'},
+            {'$project': {
+                'reply': {
+                    '_id': 1,
+                    'active_votes': 1,
+                    'author': 1,
+                    'body': 1,
+                    'category': 1,
+                    'created': 1,
+                    'depth': 1,
+                    'json_metadata': 1,
+                    'parent_author': 1,
+                    'parent_permlink': 1,
+                    'permlink': 1,
+                    'root_namespace': 1,
+                    'root_post': 1,
+                    'root_title': 1,
+                    'title': 1,
+                    'url': 1,
+                },
+                'parent': {
+                    '_id': 1,
+                    'active_votes': 1,
+                    'author': 1,
+                    'body': 1,
+                    'category': 1,
+                    'created': 1,
+                    'depth': 1,
+                    'parent_author': 1,
+                    'parent_permlink': 1,
+                    'permlink': 1,
+                    'namespace': 1,
+                    'root_namespace': 1,
+                    'root_title': 1,
+                    'title': 1,
+                    'url': 1,
+                }
+            }},
+            {'$limit': limit + skip},
+        ]
+    query = {'parent_author': username}
+    total = db.replies.count(query) + db.replies_archive.count(query)
+    # Each tier is read up to the end of the page, then merged
+    replies = list(db.replies.aggregate(pipeline('posts', 'replies')))
+    replies += list(db.replies_archive.aggregate(pipeline('posts_archive', 'replies_archive')))
+    replies = sorted(replies, key=lambda reply: reply['reply']['created'], reverse=True)[skip:skip + limit]
     results = []
     for idx, reply in enumerate(replies):
         # Format parent votes
@@ -260,17 +395,16 @@ def replies(username):
         })
         # Temporary way to retrieve forum
         if 'root_namespace' in reply['reply']:
-            reply['forum'] = db.forums.find_one({
-                '_id': reply['reply']['root_namespace']
-            }, {
-                '_id': 1,
-                'creator': 1,
-                'exclusive': 1,
-                'funded': 1,
-                'name': 1,
-                'tags': 1,
-            })
+            reply['forum'] = forums_registry.get(reply['reply']['root_namespace'], [
+                '_id',
+                'creator',
+                'exclusive',
+                'funded',
+                'name',
+                'tags',
+            ])
         results.append(reply)
+    join_content(db, [reply['reply'] for reply in results] + [reply['parent'] for reply in results])
     return response({
         'replies': results,
         'total': total,
@@ -303,11 +437,10 @@ def accountResponses(username):
     perPage = 20
     skip = (page - 1) * perPage
     limit = perPage
-    total = db.replies.count(query)
-    responses = db.replies.find(query, fields).sort(
-        sort).skip(skip).limit(limit)
+    total = db.replies.count(query) + db.replies_archive.count(query)
+    responses = find_merged([db.replies, db.replies_archive], query, fields, sort, skip, limit)
     return response({
-        'responses': list(responses),
+        'responses': responses,
         'total': total,
         'page': page
     })
@@ -318,38 +451,45 @@ def tags():
     query = {}
     sort = [("last_reply", -1)]
     results = db.topics.find(query).sort(sort)
-    return response(list(results))
+    return stream_response(results)
 
 
 @app.route("/search")
 def search():
-    pipeline = [
-        {
-            '$match': {
-                '$text': {
-                    '$search': request.args.get('q')
-                }
-            }
-        },
-        {
-            '$sort': {
-                'score': {
-                    '$meta': "textScore"
-                }
-            }
-        },
-        {
-            '$project': {
-                'title': '$title',
-                'description': '$url'
-            }
-        },
-        {
-            '$limit': 5
-        }
-    ]
-    results = db.posts.aggregate(pipeline)
-    return response(list(results))
+    # ?forum=<slug> and ?tag=<category> narrow the results
+    try:
+        page = int_arg('page', 1, 1, 1000)
+        perPage = int_arg('limit', 5, 1, 50)
+    except ValueError:
+        return bad_request('page and limit must be numbers')
+    tags = False
+    accounts = False
+    namespace = False
+    forumFilter = request.args.get('forum', False)
+    if forumFilter:
+        forum = forums_registry.get(forumFilter)
+        if not forum:
+            return response([], status='not-found')
+        if 'exclusive' in forum and forum['exclusive'] == True:
+            namespace = forumFilter
+        else:
+            # Like the forum's listing, its tags and accounts both apply
+            tags = forum.get('tags') or False
+            accounts = forum.get('accounts') or False
+            if not tags and not accounts:
+                # Unconfigured, it lists nothing
+                return response([], meta={'total': 0, 'page': page})
+    tagFilter = request.args.get('tag', False)
+    if tagFilter:
+        tags = [tagFilter]
+    skip = (page - 1) * perPage
+    limit = perPage
+    try:
+        results, total = fulltext_search(search_db, request.args.get('q'), tags=tags, accounts=accounts, namespace=namespace, forum=forumFilter, skip=skip, limit=limit)
+    except sqlite3.OperationalError:
+        # The indexer hasn't created the search index (yet)
+        return response([], meta={'total': 0, 'page': page}, status='unavailable')
+    return response(results, meta={'total': total, 'page': page})
 
 
 @app.route('/forum/<slug>')
@@ -358,7 +498,7 @@ def forum(slug):
     query = {
         '_id': slug
     }
-    forum = db.forums.find_one(query)
+    forum = forums_registry.get(slug)
     # No forum? Look for a reservation
     if not forum:
         reservation = db.forum_requests.find_one(query)
@@ -367,10 +507,7 @@ def forum(slug):
     if 'tags' not in forum and 'accounts' not in forum:
         return response(list(), forum=forum, meta={'configured': False})
     # Load children forums
-    query = {
-        'parent': str(forum['_id'])
-    }
-    children = db.forums.find(query)
+    children = forums_registry.children(forum['_id'])
     # Load the posts
     query = {}
     # ?filter=all will allow display of all posts
@@ -425,16 +562,33 @@ def forum(slug):
     perPage = 20
     skip = (page - 1) * perPage
     limit = perPage
+    # Configured forums are listed from their materialized feed, except for
+    # ?filter=all, which includes posts removed from the forum
+    if postFilter != 'all' and (forum.get('tags') or forum.get('accounts')):
+        query = {
+            'forum': slug
+        }
+        if postFilter != False:
+            query.update({
+                'category': postFilter
+            })
+        fields['post'] = 1
+        results = db.forum_feed.find(query, fields).sort(sort).skip(skip).limit(limit)
+        return response(list(load_feed(results)), forum=forum, children=children, meta={'query': query, 'sort': sort})
     results = db.posts.find(query, fields).sort(sort).skip(skip).limit(limit)
     return response(list(results), forum=forum, children=children, meta={'query': query, 'sort': sort})
 
+
+def load_feed(entries):
+    # Feed entries are keyed by forum|post, return them as the posts
+    for entry in entries:
+        entry['_id'] = entry.pop('post')
+        yield entry
+
 @app.route('/status/<slug>')
 def status(slug):
     # Load the specified forum
-    query = {
-        '_id': slug
-    }
-    forum = db.forums.find_one(query)
+    forum = forums_registry.get(slug)
     # And those who funded it
     query = {
         'ns': slug
@@ -451,6 +605,37 @@ def status(slug):
         'contributors': list(contributions)
     }, forum=forum)
 
+@app.route('/stats/<slug>')
+def forum_stats(slug):
+    # Activity of the forum over time: ?from=&to= (unix timestamps, the last
+    # day by default), ?resolution=minute|hour|day (picked from the range if
+    # not given, or too fine for it) and ?metrics=posts,replies,...
+    forum = forums_registry.get(slug)
+    if not forum:
+        return response([], status='not-found')
+    now = datetime.utcnow()
+    resolution = request.args.get('resolution', 'hour')
+    if resolution not in [r[0] for r in timeseries.resolutions]:
+        resolution = 'hour'
+    try:
+        end = datetime.utcfromtimestamp(float(request.args['to'])) if 'to' in request.args else now
+        if 'from' in request.args:
+            start = datetime.utcfromtimestamp(float(request.args['from']))
+        else:
+            start = end - timeseries.default_range(resolution)
+    except (ValueError, OverflowError, OSError):
+        return bad_request('from and to must be unix timestamps')
+    resolution = timeseries.pick_resolution(start, end, now, resolution)
+    start, end = timeseries.clamp(start, end, resolution)
+    fields = [m for m in request.args.get('metrics', '').split(',') if m in timeseries.metrics] or timeseries.metrics
+    series = timeseries.load_series(db, slug, resolution, start, end, fields)
+    return response(series, forum=forum, meta={
+        'resolution': resolution,
+        'from': start,
+        'to': end,
+    })
+
+
 @app.route('/topics/<category>')
 def topics(category):
     query = {
@@ -477,13 +662,10 @@ def post(category, author, permlink):
     post = load_post(author, permlink)
     if post:
         # Load the specified forum
-        query = {
-            'tags': {'$in': [post['category']]}
-        }
-        forum = db.forums.find_one(query)
+        forum = forums_registry.for_tag(post['category'])
         return response(post, forum=forum)
     else:
-        post = s.get_content(author, permlink).copy()
+        post = content_cache.get(author, permlink).copy()
         return response(post)
 
 
@@ -495,7 +677,39 @@ def responses(category, author, permlink):
     sort = [
         ('created', 1)
     ]
-    return response(list(load_replies(query, sort)))
+    collection = thread_replies(db, query['root_post'])
+    # ?limit=N returns a page of replies, followed by ?after=<cursor>
+    if 'limit' in request.args:
+        after = request.args.get('after', False)
+        try:
+            limit = int_arg('limit', 20, 1, 500)
+            if after:
+                cursor_query(after)
+        except ValueError:
+            return bad_request('limit must be a number and after a cursor from a previous page')
+        replies, cursor = load_reply_page(query, limit, after, collection)
+        return response(replies, meta={'next': cursor})
+    return stream_response(load_replies(query, sort, collection=collection))
+
+
+@app.route('/<category>/@<author>/<permlink>/tree')
+def thread_tree(category, author, permlink):
+    # Returns the first `limit` replies to `parent` (the post by default),
+    # each with up to `branch_limit` of its own replies, `depth` levels deep.
+    # Every level has a `more` cursor for loading the rest of that branch.
+    parent = request.args.get('parent', author + '/' + permlink)
+    after = request.args.get('after', False)
+    try:
+        depth = int_arg('depth', 2, 1, 5)
+        limit = int_arg('limit', 20, 1, 100)
+        branch_limit = int_arg('branch_limit', 5, 1, limit)
+        if after:
+            cursor_query(after)
+    except ValueError:
+        return bad_request('depth, limit and branch_limit must be numbers and after a cursor from a previous page')
+    collection = thread_replies(db, author + '/' + permlink)
+    replies, more = load_reply_tree(parent, depth, limit, branch_limit, after, collection)
+    return response(replies, meta={'more': more})
 
 
 @app.route('/active')
@@ -525,12 +739,163 @@ def ns_lookup():
     query = {
         '_id': ns
     }
-    forums = db.forums.find_one(query)
-    requests = db.forum_requests.find_one(query)
+    exists = bool(forums_registry.get(ns))
+    if not exists:
+        exists = bool(db.forum_requests.find_one(query))
     return response({
-        'exists': bool(forums or requests)
+        'exists': exists
+    })
+
+# Most ids of each kind a single /batch request may ask for, threads to load
+# the replies of and replies loaded per thread
+batch_limit = 100
+batch_threads_limit = 10
+batch_replies_limit = 100
+
+
+@app.route('/batch', methods=['GET', 'POST'])
+def batch():
+    # Resolves many posts (or replies) by id, forums by slug, account
+    # summaries, the replies of threads (as /responses) and the funding of
+    # forums (as /status) in one request, with a single query per collection:
+    #
+    #   /batch?posts=author/permlink,...&forums=slug,...&accounts=username,...
+    #         &responses=author/permlink,...&limit=20&status=slug,...
+    #
+    # or the same keys POSTed as JSON lists. Unknown ids map to null. Each
+    # thread's responses are its first `limit` replies and the cursor of the
+    # next page, as /responses?limit= returns them.
+    body = request.get_json(silent=True) or {}
+    def ids(key, limit=batch_limit):
+        if key in body and isinstance(body[key], list):
+            values = body[key]
+        else:
+            values = request.args.get(key, '').split(',')
+        return [str(value) for value in values if value][:limit]
+    data = {}
+    posts = ids('posts')
+    if posts:
+        found = {}
+        for post in db.posts.find({'_id': {'$in': posts}}):
+            found[post['_id']] = format_votes(post) if 'active_votes' in post else post
+        for collection in [db.replies, db.posts_archive, db.replies_archive]:
+            missing = [_id for _id in posts if _id not in found]
+            if not missing:
+                break
+            for comment in collection.find({'_id': {'$in': missing}}):
+                found[comment['_id']] = format_votes(comment) if 'active_votes' in comment else comment
+        join_content(db, list(found.values()))
+        data['posts'] = {_id: found.get(_id) for _id in posts}
+    forums = ids('forums')
+    if forums:
+        data['forums'] = {slug: forums_registry.get(slug) for slug in forums}
+    accounts = ids('accounts')
+    if accounts:
+        summary = {account: {'posts': 0, 'replies': 0, 'last_post': None, 'last_reply': None} for account in accounts}
+        for collection, total, last in [
+            (db.posts, 'posts', 'last_post'),
+            (db.posts_archive, 'posts', 'last_post'),
+            (db.replies, 'replies', 'last_reply'),
+            (db.replies_archive, 'replies', 'last_reply'),
+        ]:
+            results = collection.aggregate([
+                {'$match': {'author': {'$in': accounts}}},
+                {'$group': {'_id': '$author', 'count': {'$sum': 1}, 'last': {'$max': '$created'}}}
+            ])
+            for doc in results:
+                account = summary[doc['_id']]
+                account[total] += doc['count']
+                if account[last] is None or doc['last'] > account[last]:
+                    account[last] = doc['last']
+        data['accounts'] = summary
+    threads = ids('responses', batch_threads_limit)
+    if threads:
+        try:
+            limit = int_arg('limit', 20, 1, batch_replies_limit)
+        except ValueError:
+            return bad_request('limit must be a number')
+        found = {}
+        for _id in threads:
+            replies, cursor = load_reply_page({'root_post': _id}, limit, collection=thread_replies(db, _id))
+            found[_id] = {'replies': replies, 'next': cursor}
+        data['responses'] = found
+    statuses = ids('status')
+    if statuses:
+        found = {slug: {'history': [], 'contributors': []} for slug in statuses}
+        for funding in db.funding.find({'ns': {'$in': statuses}}).sort([('timestamp', -1)]):
+            found[funding['ns']]['history'].append(funding)
+        contributions = db.funding.aggregate([
+            {'$match': {'ns': {'$in': statuses}}},
+            {'$group': {'_id': {'ns': '$ns', 'from': '$from'}, 'count': {'$sum': 1}, 'total': {'$sum': '$steem_value'}}},
+            {'$sort': {'total': -1}}
+        ])
+        for doc in contributions:
+            found[doc['_id']['ns']]['contributors'].append({'_id': doc['_id']['from'], 'count': doc['count'], 'total': doc['total']})
+        data['status'] = found
+    return response(data)
+
+
+# Pushes the events the indexer logs to subscribed clients. Every open stream
+# holds its worker under the sync uwsgi config, so serve /events from
+# asyncserver.py (or main_async.ini) where they're greenlets.
+event_broker = EventBroker(
+    db,
+    max_subscriptions=int(os.environ['events_max_subscriptions']) if 'events_max_subscriptions' in os.environ else 1000,
+)
+events_keepalive = 15
+events_max_channels = 20
+# Most missed events replayed to a reconnecting client
+events_replay_limit = 500
+
+
+@app.route('/events')
+def events():
+    # Server-sent events for ?forum=slug&thread=author/permlink&user=username,
+    # each a comma separated list. Reconnecting clients send Last-Event-ID
+    # (or ?after=id) and first receive the events they missed.
+    channels = []
+    for key in ['forum', 'thread', 'user']:
+        for value in request.args.get(key, '').split(','):
+            if value:
+                channels.append(key + ':' + value)
+    if not channels or len(channels) > events_max_channels:
+        return response({}, meta={'max_channels': events_max_channels}, status='invalid-channels')
+    subscription = event_broker.subscribe(channels)
+    if not subscription:
+        return response({}, status='unavailable')
+    after = request.headers.get('Last-Event-ID', request.args.get('after', False))
+    missed = event_broker.replay(channels, after, events_replay_limit) if after else []
+
+    def encode(event):
+        return 'id: {}\nevent: {}\ndata: {}\n\n'.format(event['_id'], event['type'], dumps(event['data']).decode('utf-8'))
+
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            seen = set()
+            for event in missed:
+                seen.add(event['_id'])
+                yield encode(event)
+            while not subscription.overflowed:
+                event = subscription.get(events_keepalive)
+                if event is None:
+                    yield ': keepalive\n\n'
+                elif event['_id'] not in seen:
+                    yield encode(event)
+        finally:
+            event_broker.unsubscribe(subscription)
+
+    return Response(stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
     })
 
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/height')
 def height():
     query = {
@@ -541,8 +906,8 @@ def height():
 
 @app.route("/config")
 def config():
-    results = db.forums.find()
-    return response(list(results))
+    results = forums_registry.all()
+    return stream_response(iter(results))
 
 @app.route("/platforms")
 def platforms():
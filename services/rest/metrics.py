@@ -0,0 +1,199 @@
+from pymongo import monitoring
+import cProfile
+import io
+import pstats
+import random
+import sys
+import threading
+import time
+
+# Per route request metrics, exported in the Prometheus text format by
+# /metrics. Counters are kept per process: with several uwsgi processes each
+# one reports its own, so scrape with a `process` label or sum them.
+
+buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+
+class RequestState(threading.local):
+    # What the current request (thread, or greenlet once patched) has spent
+    def __init__(self):
+        self.reset(False)
+
+    def reset(self, active=True):
+        self.active = active
+        self.route = 'unmatched'
+        self.mongo = 0.0
+        self.commands = 0
+        self.documents = 0
+        self.serialization = 0.0
+
+
+current = RequestState()
+
+
+def count_documents(reply):
+    cursor = reply.get('cursor') if hasattr(reply, 'get') else None
+    if cursor:
+        return len(cursor.get('firstBatch', cursor.get('nextBatch', [])))
+    if hasattr(reply, 'get') and isinstance(reply.get('result'), list):
+        return len(reply['result'])
+    return 0
+
+
+class CommandTimer(monitoring.CommandListener):
+    # Attributes mongo time and returned documents to the current request
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        if current.active:
+            current.mongo += event.duration_micros / 1000000.0
+            current.commands += 1
+            current.documents += count_documents(event.reply)
+
+    def failed(self, event):
+        if current.active:
+            current.mongo += event.duration_micros / 1000000.0
+            current.commands += 1
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for idx, bound in enumerate(buckets):
+            if value <= bound:
+                self.counts[idx] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.duration = {}
+        self.mongo = {}
+        self.serialization = {}
+        self.commands = {}
+        self.documents = {}
+        self.requests = {}
+
+    def observe(self, route, status, duration):
+        with self.lock:
+            self.duration.setdefault(route, Histogram()).observe(duration)
+            self.mongo.setdefault(route, Histogram()).observe(current.mongo)
+            self.serialization[route] = self.serialization.get(route, 0.0) + current.serialization
+            self.commands[route] = self.commands.get(route, 0) + current.commands
+            self.documents[route] = self.documents.get(route, 0) + current.documents
+            key = (route, str(status))
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, help, histograms in [
+                ('chainbb_request_duration_seconds', 'Total time spent serving the request', self.duration),
+                ('chainbb_request_mongo_seconds', 'Time spent in mongo commands per request', self.mongo),
+            ]:
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} histogram'.format(name))
+                for route, histogram in sorted(histograms.items()):
+                    for bound, count in zip(buckets, histogram.counts):
+                        lines.append('{}_bucket{{route="{}",le="{}"}} {}'.format(name, route, bound, count))
+                    lines.append('{}_bucket{{route="{}",le="+Inf"}} {}'.format(name, route, histogram.count))
+                    lines.append('{}_sum{{route="{}"}} {}'.format(name, route, histogram.sum))
+                    lines.append('{}_count{{route="{}"}} {}'.format(name, route, histogram.count))
+            for name, help, counters in [
+                ('chainbb_serialization_seconds_total', 'Time spent encoding JSON responses', self.serialization),
+                ('chainbb_mongo_commands_total', 'Mongo commands issued', self.commands),
+                ('chainbb_mongo_documents_total', 'Documents returned by mongo', self.documents),
+            ]:
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} counter'.format(name))
+                for route, value in sorted(counters.items()):
+                    lines.append('{}{{route="{}"}} {}'.format(name, route, value))
+            lines.append('# HELP chainbb_requests_total Requests served')
+            lines.append('# TYPE chainbb_requests_total counter')
+            for (route, status), value in sorted(self.requests.items()):
+                lines.append('chainbb_requests_total{{route="{}",status="{}"}} {}'.format(route, status, value))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+def serializing(fn, *args):
+    # Time a serialization call made outside of a streamed body
+    started = time.time()
+    try:
+        return fn(*args)
+    finally:
+        current.serialization += time.time() - started
+
+
+def serialized_stream(chunks):
+    # Streamed bodies read from mongo while encoding, count only the encoding
+    chunks = iter(chunks)
+    while True:
+        started = time.time()
+        mongo = current.mongo
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            return
+        finally:
+            current.serialization += (time.time() - started) - (current.mongo - mongo)
+        yield chunk
+
+
+class RequestMetrics(object):
+    """ WSGI middleware recording each request once its body has been sent,
+        so streamed responses are measured in full.
+
+        With `sample_rate` > 0 that share of requests also runs under
+        cProfile, and the profile is logged when the request took longer
+        than `slow` seconds.
+    """
+
+    def __init__(self, app, sample_rate=0.0, slow=1.0):
+        self.app = app
+        self.sample_rate = sample_rate
+        self.slow = slow
+
+    def __call__(self, environ, start_response):
+        current.reset()
+        started = time.time()
+        profile = None
+        if self.sample_rate and random.random() < self.sample_rate:
+            profile = cProfile.Profile()
+            profile.enable()
+        status = []
+
+        def capture(code, headers, exc_info=None):
+            status.append(code.split(' ')[0])
+            return start_response(code, headers, exc_info)
+
+        body = self.app(environ, capture)
+        try:
+            for chunk in body:
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            duration = time.time() - started
+            if profile:
+                profile.disable()
+                if duration >= self.slow:
+                    self.log_profile(environ, duration, profile)
+            metrics.observe(current.route, status[0] if status else '500', duration)
+            current.active = False
+
+    def log_profile(self, environ, duration, profile):
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats('cumulative').print_stats(25)
+        print('[FORUM][REST][profile] {} {} took {:.3f}s ({:.3f}s mongo, {} commands)\n{}'.format(
+            environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'), duration, current.mongo, current.commands, output.getvalue()))
+        sys.stdout.flush()
@@ -5,7 +5,12 @@ except ImportError:
         import json
     except ImportError:
         raise ImportError
+try:
+    import orjson
+except ImportError:
+    orjson = None
 import datetime
+import uuid
 from bson.objectid import ObjectId
 from werkzeug import Response
 
@@ -21,3 +26,54 @@ def jsonify(*args, **kwargs):
     """ jsonify with support for MongoDB ObjectId
     """
     return Response(json.dumps(dict(*args, **kwargs), cls=MongoJsonEncoder), mimetype='application/json')
+
+
+# orjson handles datetime natively (same isoformat output), only ObjectId
+# needs to fall back into python
+def _orjson_default(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError
+
+
+_encoder = MongoJsonEncoder(separators=(',', ':'))
+
+
+def dumps(obj):
+    """ Serialize to JSON bytes, using orjson when it is installed
+    """
+    if orjson:
+        return orjson.dumps(obj, default=_orjson_default, option=orjson.OPT_NON_STR_KEYS)
+    return _encoder.encode(obj).encode('utf-8')
+
+
+def stream_envelope(envelope, placeholder, items, chunk_size=100):
+    """ Yield the JSON for `envelope` in chunks, with `placeholder` replaced
+        by a list encoded item by item while `items` is being iterated
+    """
+    # Encode the envelope once with a unique marker where the list goes
+    marker = '__stream_{}__'.format(uuid.uuid4().hex)
+    head, tail = dumps(_replace(envelope, placeholder, marker)).split(dumps(marker), 1)
+    yield head + b'['
+    first = True
+    chunk = []
+    for item in items:
+        chunk.append(dumps(item))
+        if len(chunk) >= chunk_size:
+            yield (b'' if first else b',') + b','.join(chunk)
+            first = False
+            chunk = []
+    if chunk:
+        yield (b'' if first else b',') + b','.join(chunk)
+    yield b']' + tail
+
+
+def _replace(obj, placeholder, value):
+    # Copy the nested dict/list structure, swapping in `value` for `placeholder`
+    if obj is placeholder:
+        return value
+    if isinstance(obj, dict):
+        return {k: _replace(v, placeholder, value) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [_replace(v, placeholder, value) for v in obj]
+    return obj
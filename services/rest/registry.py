@@ -0,0 +1,81 @@
+import threading
+import time
+
+
+class ForumRegistry(object):
+    """ In-memory copy of the `forums` collection with tag/account lookups and
+        the parent -> children tree.
+
+        Every service that writes to `forums` increments the `forums` document
+        of the `versions` collection, and the registry reloads itself once it sees a new
+        version (checked at most every `interval` seconds).
+    """
+
+    def __init__(self, db, interval=2):
+        self.db = db
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.version = None
+        self.state = None
+
+    def refresh(self, force=False):
+        now = time.time()
+        if not force and self.state is not None and now - self.checked < self.interval:
+            return self.state
+        with self.lock:
+            # Another thread may have refreshed while we were waiting
+            if not force and self.state is not None and now - self.checked < self.interval:
+                return self.state
+            doc = self.db.versions.find_one({'_id': 'forums'})
+            version = doc['value'] if doc else 0
+            if force or self.state is None or version != self.version:
+                self.state = self.load()
+                self.version = version
+            self.checked = time.time()
+        return self.state
+
+    def load(self):
+        forums = list(self.db.forums.find())
+        by_id = {}
+        by_tag = {}
+        by_account = {}
+        children = {}
+        for forum in forums:
+            by_id[forum['_id']] = forum
+            # First match wins, like find_one in natural order
+            for tag in forum.get('tags', None) or []:
+                by_tag.setdefault(tag, forum)
+            for account in forum.get('accounts', None) or []:
+                by_account.setdefault(account, forum)
+            if 'parent' in forum:
+                children.setdefault(str(forum['parent']), []).append(forum)
+        # Same order as sort([("highlight", -1), ("_id", 1), ("parent", 1)])
+        ordered = sorted(forums, key=lambda forum: str(forum['_id']))
+        ordered = sorted(ordered, key=lambda forum: (1, forum['highlight']) if forum.get('highlight') is not None else (0,), reverse=True)
+        return {
+            'forums': forums,
+            'ordered': ordered,
+            'by_id': by_id,
+            'by_tag': by_tag,
+            'by_account': by_account,
+            'children': children,
+        }
+
+    def get(self, _id, fields=None):
+        forum = self.refresh()['by_id'].get(_id)
+        if forum and fields:
+            return {k: v for k, v in forum.items() if k in fields or k == '_id'}
+        return forum
+
+    def for_tag(self, tag):
+        return self.refresh()['by_tag'].get(tag)
+
+    def for_account(self, account):
+        return self.refresh()['by_account'].get(account)
+
+    def children(self, _id):
+        return self.refresh()['children'].get(str(_id), [])
+
+    def all(self, ordered=False):
+        return self.refresh()['ordered' if ordered else 'forums']
@@ -0,0 +1,62 @@
+import re
+import sqlite3
+import threading
+
+# Reads the search index the indexer maintains (services/indexer/steem/search.py)
+
+local = threading.local()
+
+
+def connection(path):
+    if getattr(local, 'conn', None) is None:
+        local.conn = sqlite3.connect('file:{}?mode=ro'.format(path), uri=True)
+    return local.conn
+
+
+def match_expression(q):
+    # Quote every word so user input can't be parsed as FTS5 syntax
+    words = re.findall(r'\w+', q or '', re.UNICODE)
+    return ' '.join('"{}"'.format(word) for word in words)
+
+
+def search(path, q, tags=False, accounts=False, namespace=False, forum=False, skip=0, limit=5):
+    expression = match_expression(q)
+    if not expression:
+        return [], 0
+    where = ['search MATCH ?']
+    params = [expression]
+    if tags:
+        where.append('d.category IN ({})'.format(','.join('?' * len(tags))))
+        params.extend(tags)
+    if accounts:
+        where.append('d.author IN ({})'.format(','.join('?' * len(accounts))))
+        params.extend(accounts)
+    if namespace:
+        where.append('d.namespace = ?')
+        params.append(namespace)
+    # Within a forum, hide posts removed from it, otherwise hide any removed post
+    if forum:
+        where.append('NOT EXISTS (SELECT 1 FROM removed r WHERE r.post_id = d.id AND r.forum = ?)')
+        params.append(forum)
+    else:
+        where.append('NOT EXISTS (SELECT 1 FROM removed r WHERE r.post_id = d.id)')
+    where = ' AND '.join(where)
+    conn = connection(path)
+    total = conn.execute('''SELECT COUNT(*)
+        FROM search JOIN documents d ON d.rowid = search.rowid
+        WHERE {}'''.format(where), params).fetchone()[0]
+    # Title matches weigh double, as they did in the mongo text index
+    rows = conn.execute('''SELECT d.id, d.title, d.url, d.author, d.category, d.created
+        FROM search JOIN documents d ON d.rowid = search.rowid
+        WHERE {}
+        ORDER BY bm25(search, 10.0, 5.0)
+        LIMIT ? OFFSET ?'''.format(where), params + [limit, skip]).fetchall()
+    results = [{
+        '_id': row[0],
+        'title': row[1],
+        'description': row[2],
+        'author': row[3],
+        'category': row[4],
+        'created': row[5],
+    } for row in rows]
+    return results, total
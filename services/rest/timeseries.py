@@ -0,0 +1,79 @@
+from datetime import timedelta
+
+# Reads the per forum time series the statistics service rolls up into
+# `timeseries` (see rollups.py there) as a list of evenly spaced points.
+
+metrics = ['posts', 'replies', 'deletes', 'removed', 'restored', 'fundings', 'funding']
+
+resolutions = [
+    # Resolution, step, default and longest range, how long it's kept
+    ('minute', timedelta(minutes=1), timedelta(hours=1), timedelta(days=1), timedelta(days=2)),
+    ('hour', timedelta(hours=1), timedelta(days=1), timedelta(days=31), timedelta(days=90)),
+    ('day', timedelta(days=1), timedelta(days=30), timedelta(days=3 * 366), None),
+]
+
+
+def floor(ts, resolution):
+    if resolution == 'minute':
+        return ts.replace(second=0, microsecond=0)
+    if resolution == 'hour':
+        return ts.replace(minute=0, second=0, microsecond=0)
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def span_start(ts, resolution):
+    # The start of the document holding the slot of `ts`
+    if resolution == 'minute':
+        return ts.replace(minute=0, second=0, microsecond=0)
+    if resolution == 'hour':
+        return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    return ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def slot_time(start, resolution, slot):
+    if resolution == 'minute':
+        return start + timedelta(minutes=slot)
+    if resolution == 'hour':
+        return start + timedelta(hours=slot)
+    return start.replace(day=slot)
+
+
+def default_range(resolution):
+    return [r[2] for r in resolutions if r[0] == resolution][0]
+
+
+def pick_resolution(start, end, now, finest='minute'):
+    # The finest resolution, no finer than `finest`, that is still kept for
+    # `start` and can cover the range. Older ranges are served downsampled.
+    names = [r[0] for r in resolutions]
+    for name, step, default, longest, keep in resolutions[names.index(finest):]:
+        if (keep is None or start >= now - keep) and end - start <= longest:
+            return name
+    return 'day'
+
+
+def clamp(start, end, resolution):
+    longest = [r[3] for r in resolutions if r[0] == resolution][0]
+    return max(start, end - longest), end
+
+
+def load_series(db, forum, resolution, start, end, fields=metrics):
+    step = [r[1] for r in resolutions if r[0] == resolution][0]
+    values = {}
+    for doc in db.timeseries.find({
+        'forum': forum,
+        'resolution': resolution,
+        'start': {'$gte': span_start(start, resolution), '$lte': end},
+    }):
+        for slot, value in doc['values'].items():
+            values[slot_time(doc['start'], resolution, int(slot))] = value
+    series = []
+    ts = floor(start, resolution)
+    while ts <= end:
+        point = {'ts': ts}
+        value = values.get(ts, {})
+        for field in fields:
+            point[field] = value.get(field, 0)
+        series.append(point)
+        ts += step
+    return series
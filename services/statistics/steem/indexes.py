@@ -0,0 +1,27 @@
+# Indexes the statistics queries run on, applied when the service starts.
+# create_index is a no-op for indexes that already exist.
+
+indexes = {
+    'activeusers_hll': [
+        ([('granularity', 1), ('start', 1)], {}),
+    ],
+    'forums': [
+        ([('_update', 1)], {'sparse': True}),
+    ],
+    'funding': [
+        ([('ns', 1), ('timestamp', -1)], {}),
+    ],
+    'stats_jobs': [
+        ([('priority', -1), ('queued', 1)], {}),
+    ],
+    'timeseries': [
+        # Minute and hour resolution series are only kept for a while
+        ([('expires', 1)], {'expireAfterSeconds': 0}),
+    ],
+}
+
+
+def ensure_indexes(db):
+    for collection, specs in sorted(indexes.items()):
+        for keys, options in specs:
+            db[collection].create_index(keys, **options)
@@ -0,0 +1,153 @@
+from collections import deque
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+import os
+import socket
+import threading
+import time
+import traceback
+
+# A queue of statistics jobs in the `stats_jobs` collection, shared by every
+# statistics instance. There's one document per job (ie: `forum:steem`), so
+# queueing a job that's already waiting only raises its priority and bumps
+# its version. Workers claim the highest priority job that's available by
+# pushing `available` past a lease, and delete it once done, unless it was
+# queued again while running (its version changed), in which case it's left
+# to run again. A job whose worker died becomes available when its lease ends.
+
+priority_low = 1
+priority_normal = 5
+priority_high = 10
+
+
+def enqueue(db, kind, key, priority=priority_normal):
+    now = datetime.utcnow()
+    db.stats_jobs.update({'_id': kind + ':' + key}, {
+        '$max': {'priority': priority},
+        '$inc': {'version': 1},
+        '$setOnInsert': {
+            'kind': kind,
+            'key': key,
+            'queued': now,
+            'available': now,
+            'attempts': 0,
+        },
+    }, upsert=True)
+
+
+class JobQueue(object):
+    def __init__(self, db, handlers, workers=4, lease=60, max_attempts=5, log=print):
+        self.db = db
+        self.handlers = handlers
+        self.workers = workers
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.log = log
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        # Queued to done (latency) and run time of recent jobs, in seconds
+        self.latencies = deque(maxlen=1000)
+        self.durations = deque(maxlen=1000)
+
+    def start(self):
+        for idx in range(self.workers):
+            thread = threading.Thread(target=self.work, name='stats-worker-{}'.format(idx))
+            thread.daemon = True
+            thread.start()
+
+    def claim(self):
+        now = datetime.utcnow()
+        return self.db.stats_jobs.find_one_and_update(
+            {'available': {'$lte': now}},
+            {
+                '$set': {'available': now + timedelta(seconds=self.lease), 'owner': self.owner},
+                '$inc': {'attempts': 1},
+            },
+            sort=[('priority', -1), ('queued', 1)],
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def complete(self, job):
+        result = self.db.stats_jobs.delete_one({'_id': job['_id'], 'version': job['version']})
+        if not result.deleted_count:
+            # Queued again while running, make it available for another pass
+            self.db.stats_jobs.update({'_id': job['_id']}, {
+                '$set': {'available': datetime.utcnow(), 'queued': datetime.utcnow(), 'attempts': 0},
+                '$unset': {'owner': True},
+            })
+
+    def fail(self, job):
+        if job['attempts'] >= self.max_attempts:
+            self.log('dropping {} after {} attempts'.format(job['_id'], job['attempts']))
+            self.db.stats_jobs.delete_one({'_id': job['_id'], 'version': job['version']})
+            return
+        # Back off before retrying
+        retry = datetime.utcnow() + timedelta(seconds=30 * job['attempts'])
+        self.db.stats_jobs.update({'_id': job['_id']}, {'$set': {'available': retry}, '$unset': {'owner': True}})
+
+    def run(self, job):
+        started = time.time()
+        try:
+            self.handlers[job['kind']](job['key'])
+        except Exception:
+            self.log('{} failed\n{}'.format(job['_id'], traceback.format_exc()))
+            with self.lock:
+                self.failed += 1
+            self.fail(job)
+            return
+        self.complete(job)
+        with self.lock:
+            self.processed += 1
+            self.durations.append(time.time() - started)
+            self.latencies.append((datetime.utcnow() - job['queued']).total_seconds())
+
+    def work(self):
+        while True:
+            try:
+                job = self.claim()
+            except Exception as e:
+                self.log('claiming a job failed: {}'.format(e))
+                job = None
+            if job:
+                self.run(job)
+            else:
+                time.sleep(1)
+
+    def metrics(self):
+        now = datetime.utcnow()
+        depth = {}
+        for doc in self.db.stats_jobs.aggregate([
+            {'$group': {'_id': '$priority', 'count': {'$sum': 1}}}
+        ]):
+            depth[str(doc['_id'])] = doc['count']
+        ready = self.db.stats_jobs.count({'available': {'$lte': now}})
+        oldest = list(self.db.stats_jobs.find({}, {'queued': 1}).sort([('queued', 1)]).limit(1))
+        with self.lock:
+            latencies = sorted(self.latencies)
+            durations = sorted(self.durations)
+            instance = {
+                'workers': self.workers,
+                'processed': self.processed,
+                'failed': self.failed,
+                'latency': summarize(latencies),
+                'duration': summarize(durations),
+                'updated': now,
+            }
+        return {
+            'depth': sum(depth.values()),
+            'ready': ready,
+            'by_priority': depth,
+            'oldest': (now - oldest[0]['queued']).total_seconds() if oldest else 0,
+        }, instance
+
+
+def summarize(values):
+    if not values:
+        return {'p50': 0, 'p95': 0, 'max': 0}
+    return {
+        'p50': values[int((len(values) - 1) * 0.5)],
+        'p95': values[int((len(values) - 1) * 0.95)],
+        'max': values[-1],
+    }
@@ -1,11 +1,18 @@
 from apscheduler.schedulers.background import BackgroundScheduler
 from pprint import pprint
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
+from collections import OrderedDict
+from datetime import datetime, timedelta
 import time
 import inspect
 import sys
 import os
 
+from hll import HyperLogLog
+from indexes import ensure_indexes
+from jobs import JobQueue, enqueue, priority_high, priority_low, priority_normal
+from rollups import process_events
+
 ns = os.environ['namespace'] if 'namespace' in os.environ else 'chainbb'
 mongo = MongoClient("mongodb://mongo")
 db = mongo[ns]
@@ -17,27 +24,65 @@ def l(msg):
 
 
 def update_statistics():
-    # l("Updating stats for all forums...")
-    forums = db.forums.find()
-    for forum in forums:
-        l(forum['_id'])
+    # Refresh every forum at once, behind anything queued by the indexer
+    enqueue(db, 'forums', 'all', priority_low)
+
+def queue_flagged_forums():
+    # Forums flagged for an update with `_update` before the job queue existed
+    for forum in db.forums.find({'_update': True}, {'_id': 1}):
+        enqueue(db, 'forum', forum['_id'], priority_high)
+        db.forums.update({'_id': forum['_id']}, {'$unset': {'_update': True}})
+
+def run_forum_job(_id):
+    l(_id)
+    forum = db.forums.find_one({'_id': _id})
+    if forum:
         update_forum(forum)
+        # Collapses into a single pending homepage job during bursts
+        enqueue(db, 'homepage', 'homepage', priority_normal)
 
-def update_statistics_queue():
-    # l("Updating stats for next queued forum...")
-    forums = db.forums.find({'_update': True}).limit(5)
-    for forum in forums:
-        l(forum['_id'])
-        update_forum(forum)
+def run_all_forums_job(key):
+    updated = update_all_forums()
+    l('updated {} forums'.format(updated))
+    enqueue(db, 'homepage', 'homepage', priority_normal)
+
+def run_homepage_job(key):
+    update_homepage()
+
+def run_rollups_job(key):
+    processed = process_events(db)
+    if processed:
+        l('rolled up {} events'.format(processed))
+
+def queue_rollups():
+    # A queued job, so only one instance rolls up the events at a time
+    enqueue(db, 'rollups', 'events', priority_normal)
 
 def update_forum(forum):
+    # stats.posts, stats.replies and the latest content are kept by the
+    # indexer as it goes
     update_forum_funding(forum)
-    update_forum_stats(forum)
-    update_latest_content(forum)
-
-def update_latest_content(forum):
-    update_latest_post(forum)
-    update_latest_reply(forum)
+    bump_forums_version()
+
+def bump_forums_version():
+    # Signals the REST forum registries to reload the forums
+    db.versions.update({'_id': 'forums'}, {'$inc': {'value': 1}}, upsert=True)
+
+def update_all_forums():
+    # Funding of every forum, from one aggregation and written with one bulk
+    # write. The latest posts and replies are kept by the indexer.
+    funding = {doc['_id']: doc['amount'] for doc in db.funding.aggregate([
+        {'$group': {'_id': '$ns', 'amount': {'$sum': '$steem_value'}}}
+    ])}
+    ops = []
+    for forum in db.forums.find({}, {'_id': 1}):
+        if forum['_id'] in funding:
+            funded = float("%.3f" % funding[forum['_id']])
+            ops.append(UpdateOne({'_id': forum['_id']}, {'$set': {'funded': funded}}))
+    if ops:
+        db.forums.bulk_write(ops, ordered=False)
+        bump_forums_version()
+    return len(ops)
 
 def update_forum_funding(forum):
     _id = forum['_id']
@@ -49,144 +94,102 @@ def update_forum_funding(forum):
         total = float("%.3f" % total[0]['amount'])
         db.forums.update({'_id': _id}, {'$set': {'funded': total}})
 
-def update_latest_post(forum):
-    if 'exclusive' in forum and forum['exclusive'] == True:
-        query = {
-            'namespace': forum['_id'],
-            '_removedFrom': {'$ne': forum['_id']}
-        }
-    else:
-        if 'tags' not in forum:
-            return
-        query = {
-            'category': {'$in': forum['tags']},
-            '_removedFrom': {'$nin': forum['tags']}
-        }
-    sort = [('created', -1)]
-    results = list(db.posts.find(query).sort(sort).limit(1))
-    query = {
-        '_id': forum['_id'],
-    }
-    if len(results) > 0:
-        comment = results[0]
-        updates = {
-            'updated': comment['created'],
-            'last_post': {
-                'created': comment['created'],
-                'author': comment['author'],
-                'title': comment['title'],
-                'url': comment['url']
+# Rolling windows of unique active users, from the indexer's HyperLogLog
+# buckets: the window's name, which buckets it merges and how many of them
+active_user_windows = [
+    ('users-1h', 'minute', timedelta(minutes=1), 60),
+    ('users-24h', 'hour', timedelta(hours=1), 24),
+    ('users-7d', 'day', timedelta(days=1), 7),
+]
+
+def update_active_users():
+    now = datetime.utcnow()
+    for _id, granularity, unit, count in active_user_windows:
+        since = now - unit * count
+        sketches = {}
+        for bucket in db.activeusers_hll.find({'granularity': granularity, 'start': {'$gt': since}}):
+            if bucket['app'] in sketches:
+                sketches[bucket['app']].merge(HyperLogLog(bucket['registers']))
+            else:
+                sketches[bucket['app']] = HyperLogLog(bucket['registers'])
+        total = sketches.pop('*', None)
+        users = {app.replace('.', '-'): sketch.count() for app, sketch in sketches.items()}
+        db.stats.update({
+            '_id': _id
+        }, {
+            '$set': {
+                'updated': now,
+                'total': total.count() if total else 0,
+                'platforms': OrderedDict(sorted(users.items(), key=lambda app: app[1], reverse=True)),
             }
-        }
-    else:
-        updates = {
-            'last_post': {}
-        }
-    results = db.forums.update(query, {'$set': updates})
-
-
-def update_latest_reply(forum):
-    if 'exclusive' in forum and forum['exclusive'] == True:
-        query = {
-            'root_namespace': forum['_id'],
-            '_removedFrom': {'$ne': forum['_id']}
-        }
-    else:
-        if 'tags' not in forum:
-            return
-        query = {
-            'category': {'$in': forum['tags']},
-            '_removedFrom': {'$nin': forum['tags']}
-        }
-    sort = [('created', -1)]
-    results = list(db.replies.find(query).sort(sort).limit(1))
+        }, upsert=True)
+
+# Forum groups displayed on the homepage
+homepage_groups = [
+    "localtesting",  # localtesting never exists on live, only in dev
+    "projects",
+    "crypto",
+    "community"
+]
+# How many of the platform's active users to include on the homepage
+homepage_users = 100
+
+def update_homepage():
+    # Materialize everything the / route returns into a single document
     query = {
-        '_id': forum['_id'],
+        "group": {"$in": homepage_groups}
     }
-    if len(results) > 0:
-        comment = results[0]
-        updates = {
-            'updated': comment['created'],
-            'last_reply': {
-                'created': comment['created'],
-                'author': comment['author'],
-                'title': comment['root_title'],
-                'url': comment['url']
-            }
-        }
-    else:
-        updates = {
-            'last_reply': {}
-        }
-    results = db.forums.update(query, {'$set': updates})
-
-def update_forum_stats(forum):
-    if ('tags' in forum):
-        if 'exclusive' in forum and forum['exclusive']:
-            stats = {
-                'posts': get_post_count(namespace=forum['_id']),
-                'replies': get_reply_count(namespace=forum['_id'])
-            }
-        else:
-            stats = {
-                'posts': get_post_count(tags=forum['tags']),
-                'replies': get_reply_count(tags=forum['tags'])
-            }
-        db.forums.update({'_id': forum['_id']}, {'$set': {'stats': stats}, '$unset': {'_update': True}})
-
-
-def get_post_count(tags=[], namespace=False):
-    if namespace:
-        return db.posts.count({
-            'namespace': namespace,
-            '_removedFrom': {'$ne': namespace},
-        })
-    return db.posts.count({
-        'category': {'$in': tags},
-        '_removedFrom': {'$nin': tags},
-    })
-
-
-def get_reply_count(tags=[], namespace=False):
-    if namespace:
-        return db.replies.count({
-            'root_namespace': namespace,
-            '_removedFrom': {'$ne': namespace},
-        })
-    return db.replies.count({
-        'category': {'$in': tags},
-        '_removedFrom': {'$nin': tags},
-    })
-
-def rebuild_activeusers_cache():
-    results = db.activeusers.aggregate([
-        {'$unwind': '$app'},
-        {'$group': {
-            '_id': '$app',
-            'sum': {'$sum': 1}
-        }},
-        {'$sort': {
-            'sum': -1
-        }}
-    ])
-    users = {doc["_id"].replace('.', '-'): doc['sum'] for doc in results}
+    sort = [("group_order", 1), ("forum_order", 1)]
+    forums = db.forums.find(query).sort(sort)
+    active = db.stats.find_one({'_id': 'users-24h'}) or {}
+    recent = db.activeusers_recent.find_one({'_id': ns}) or {'users': []}
     db.stats.update({
-        '_id': 'users-24h'
+        '_id': 'homepage'
     }, {
         '$set': {
-            'total': sum(users.values()),
-            'platforms': users,
+            'updated': datetime.utcnow(),
+            'forums': list(forums),
+            'users': {
+                'stats': {
+                    'total': active.get('total', 0),
+                    'app': active.get('platforms', {}).get(ns.replace('.', '-'), 0),
+                },
+                'list': [{'_id': user['_id']} for user in recent['users'][:homepage_users]]
+            }
         }
     }, upsert=True)
 
+# Workers processing the `stats_jobs` queue in this instance
+job_queue = JobQueue(db, {
+    'forum': run_forum_job,
+    'forums': run_all_forums_job,
+    'homepage': run_homepage_job,
+    'rollups': run_rollups_job,
+}, workers=int(os.environ['stats_workers']) if 'stats_workers' in os.environ else 4, log=l)
+
+def update_job_metrics():
+    # Queue depth and job latency, in stats/jobs
+    queue, instance = job_queue.metrics()
+    db.stats.update({'_id': 'jobs'}, {'$set': {
+        'queue': queue,
+        'instances.' + job_queue.owner.replace('.', '-'): instance,
+    }}, upsert=True)
+
 if __name__ == '__main__':
     l("starting service")
+    ensure_indexes(db)
+    queue_flagged_forums()
     update_statistics()
-    rebuild_activeusers_cache()
+    update_active_users()
+    update_homepage()
+    job_queue.start()
     scheduler = BackgroundScheduler()
-    scheduler.add_job(rebuild_activeusers_cache, 'interval', minutes=1, id='rebuild_activeusers_cache')
+    scheduler.add_job(update_active_users, 'interval', minutes=1, id='update_active_users')
+    scheduler.add_job(update_homepage, 'interval', minutes=1, id='update_homepage')
     scheduler.add_job(update_statistics, 'interval', hours=1, id='update_statistics')
-    scheduler.add_job(update_statistics_queue, 'interval', seconds=15, id='update_statistics_queue')
+    scheduler.add_job(queue_flagged_forums, 'interval', minutes=1, id='queue_flagged_forums')
+    scheduler.add_job(queue_rollups, 'interval', seconds=15, id='queue_rollups')
+    scheduler.add_job(update_job_metrics, 'interval', seconds=15, id='update_job_metrics')
     scheduler.start()
     # Loop
     try:
@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+import sys
+
+# Rolls the indexer's `events` up into per forum time series in `timeseries`,
+# at minute, hour and day resolution. Each document holds one forum's values
+# for a span of slots (the minutes of an hour, the hours of a day, the days
+# of a month), ie:
+#
+#   {_id: 'steem|hour|2018010100', forum: 'steem', resolution: 'hour',
+#    start: 2018-01-01, values: {'0': {posts: 3, replies: 12}, '1': ...}}
+#
+# Finer resolutions are kept for less time, older ranges are only available
+# downsampled. The REST service serves them from /stats/<forum>.
+#
+# The log is capped, events it dropped before they were rolled up are lost.
+# Each such gap is logged and recorded in the checkpoint's `gaps`, the series
+# undercount the range between its `from` and `to` (when the events were
+# logged).
+
+resolutions = [
+    # Resolution, the start of a document's span, a slot within it, how long it's kept
+    ('minute', lambda ts: ts.replace(minute=0, second=0, microsecond=0), lambda ts: ts.minute, timedelta(days=2)),
+    ('hour', lambda ts: ts.replace(hour=0, minute=0, second=0, microsecond=0), lambda ts: ts.hour, timedelta(days=90)),
+    ('day', lambda ts: ts.replace(day=1, hour=0, minute=0, second=0, microsecond=0), lambda ts: ts.day, None),
+]
+
+
+def event_values(event):
+    # What an event adds to its forums' series
+    kind = event['type']
+    if kind == 'post':
+        return {'posts': 1}
+    if kind == 'reply':
+        return {'replies': 1}
+    if kind == 'delete':
+        return {'deletes': 1}
+    if kind == 'moderation':
+        return {'removed': 1} if event['data'].get('removed') else {'restored': 1}
+    if kind == 'funding':
+        return {'fundings': 1, 'funding': event['data'].get('steem_value', 0)}
+    return {}
+
+
+def rollup(db, events):
+    increments = {}
+    for event in events:
+        values = event_values(event)
+        if not values:
+            continue
+        forums = [channel[6:] for channel in event['channels'] if channel.startswith('forum:')]
+        for forum in forums:
+            for resolution, span, slot, keep in resolutions:
+                start = span(event['ts'])
+                key = (forum, resolution, start, keep)
+                if key not in increments:
+                    increments[key] = {}
+                for metric, value in values.items():
+                    field = 'values.{}.{}'.format(slot(event['ts']), metric)
+                    increments[key][field] = increments[key].get(field, 0) + value
+    ops = []
+    for (forum, resolution, start, keep), inc in increments.items():
+        meta = {'forum': forum, 'resolution': resolution, 'start': start}
+        if keep:
+            meta['expires'] = start + keep
+        ops.append(UpdateOne(
+            {'_id': '{}|{}|{}'.format(forum, resolution, start.strftime('%Y%m%d%H'))},
+            {'$inc': inc, '$setOnInsert': meta},
+            upsert=True,
+        ))
+    if ops:
+        db.timeseries.bulk_write(ops, ordered=False)
+    return len(ops)
+
+
+def process_events(db, batch_size=5000):
+    # Roll up the events logged since the last run. The checkpoint is saved
+    # after each batch, a crash in between counts that batch again.
+    # Without a checkpoint, start with what's still in the log
+    checkpoint = db.stats.find_one({'_id': 'rollups'})
+    last = checkpoint['last'] if checkpoint else None
+    # The log wrapped past the checkpoint, if even the last event rolled up is gone
+    if last and not db.events.find_one({'_id': last}, {'_id': 1}):
+        oldest = db.events.find_one(sort=[('_id', 1)])
+        if oldest and oldest['_id'] > last:
+            gap = {'from': last.generation_time, 'to': oldest['_id'].generation_time, 'detected': datetime.utcnow()}
+            print('[FORUM][STATISTICS][rollups] events logged between {from} and {to} were dropped before they were rolled up'.format(**gap))
+            sys.stdout.flush()
+            db.stats.update({'_id': 'rollups'}, {'$push': {'gaps': gap}})
+    processed = 0
+    while True:
+        query = {'_id': {'$gt': last}} if last else {}
+        events = list(db.events.find(query).sort('_id', 1).limit(batch_size))
+        if not events:
+            return processed
+        rollup(db, events)
+        last = events[-1]['_id']
+        processed += len(events)
+        db.stats.update({'_id': 'rollups'}, {'$set': {'last': last, 'updated': datetime.utcnow()}}, upsert=True)
+        if len(events) < batch_size:
+            return processed